@@ -0,0 +1,216 @@
+'''
+@name    autofocus_controller.py
+@brief   Online autofocus controller which receives one (focus distance, sharpness)
+         measurement at a time and decides the next focus distance to capture.
+         After a coarse sweep, every measurement refits the cubic spline through
+         all points captured so far and the next distance is either the peak of
+         the spline or a golden-section point in the bracket around the sharpest
+         capture, until that bracket is narrower than the tolerance
+@author  Yun-Ha Jung, Russell Wong, 2017
+'''
+
+import sys, os, math, bisect
+import numpy as np
+
+import cubic_spline, spline_optimizer, focus_measures, focus_stack
+
+GR = (math.sqrt(5) - 1)/2
+DEFAULT_TOLERANCE = 2.0
+DEFAULT_INITIAL_POINTS = 5
+DEFAULT_MAX_CAPTURES = 30
+
+'''
+@name       AutofocusController
+@brief      Stateful controller proposing the next focus distance to capture
+@param[in]  x_min, x_max: range of focus distances the lens can reach
+            tol: width of the bracket around the peak at which the search stops
+            initial_points: number of evenly spaced distances in the coarse sweep
+            max_captures: maximum number of measurements before giving up
+            strategy: 'spline' to alternate between the spline peak and golden-section
+                      points, or 'golden' for golden-section points only
+            positions: optional list of the only focus distances the lens can reach
+                       (e.g. the frames of a pre-captured sweep); proposals are
+                       snapped to the nearest one not yet measured
+'''
+class AutofocusController(object):
+    def __init__(self, x_min, x_max, tol=DEFAULT_TOLERANCE, initial_points=DEFAULT_INITIAL_POINTS,
+                 max_captures=DEFAULT_MAX_CAPTURES, strategy='spline', positions=None):
+        if strategy not in ('spline', 'golden'):
+            raise ValueError('Unknown strategy %r' % strategy)
+        self.x_min = float(x_min)
+        self.x_max = float(x_max)
+        self.tol = float(tol)
+        self.max_captures = max_captures
+        self.strategy = strategy
+        self.positions = sorted(float(p) for p in positions) if positions is not None else None
+
+        # Measurements sorted by focus distance
+        self.x_vals = []
+        self.y_vals = []
+        self.coefficients = None
+        self.done = False
+        self.use_spline = strategy == 'spline'
+
+        self.initial = []
+        for x in np.linspace(self.x_min, self.x_max, initial_points):
+            x = self.snap(x, self.x_min, self.x_max)
+            if x is not None and x not in self.initial:
+                self.initial.append(x)
+
+    '''
+    @name       addMeasurement
+    @brief      record the sharpness captured at a focus distance and refit the spline
+    @param[in]  distance: focus distance of the capture
+                sharpness: sharpness of the capture
+    '''
+    def addMeasurement(self, distance, sharpness):
+        distance = float(distance)
+        i = bisect.bisect_left(self.x_vals, distance)
+        if i < len(self.x_vals) and self.x_vals[i] == distance:
+            self.y_vals[i] = float(sharpness)
+        else:
+            self.x_vals.insert(i, distance)
+            self.y_vals.insert(i, float(sharpness))
+
+        self.coefficients = None
+        if len(self.x_vals) >= 2:
+            self.coefficients = cubic_spline.getCoefficients(list(zip(self.x_vals, self.y_vals)))
+
+    '''
+    @name       getBracket
+    @brief      find the captures on either side of the sharpest capture
+    @return     (low, best, high) focus distances, where low or high equal best
+                if the sharpest capture is at the end of the measured range
+    '''
+    def getBracket(self):
+        i = int(np.argmax(self.y_vals))
+        low = self.x_vals[max(i-1, 0)]
+        high = self.x_vals[min(i+1, len(self.x_vals)-1)]
+        return low, self.x_vals[i], high
+
+    '''
+    @name       getOptimum
+    @brief      estimate the optimal focus distance from the measurements so far
+    @return     optimum: the optimum point (x,y), or None before any measurement
+    '''
+    def getOptimum(self):
+        if not self.x_vals:
+            return None
+        low, best, high = self.getBracket()
+        optimum = (best, max(self.y_vals))
+        if self.coefficients is not None:
+            # Only trust a spline peak between the neighbours of the sharpest capture
+            for peak in spline_optimizer.findPeaks(self.coefficients, self.x_vals):
+                if low <= peak[0] <= high and peak[1] >= optimum[1]:
+                    optimum = peak
+                    break
+        return optimum
+
+    '''
+    @name       snap
+    @brief      move a focus distance to the nearest reachable distance in (low, high)
+                that has not been measured yet
+    @return     float: the snapped focus distance, or None if there is none
+    '''
+    def snap(self, x, low, high):
+        if self.positions is None:
+            return float(x)
+        candidates = [p for p in self.positions if low <= p <= high and p not in self.x_vals]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: abs(p - x))
+
+    '''
+    @name       isNew
+    @brief      check whether a focus distance is far enough from every measurement
+                to be worth capturing
+    '''
+    def isNew(self, x):
+        i = bisect.bisect_left(self.x_vals, x)
+        for j in (i-1, i):
+            if 0 <= j < len(self.x_vals) and abs(self.x_vals[j] - x) < self.tol/2:
+                return False
+        return True
+
+    '''
+    @name       proposeNext
+    @brief      decide the focus distance of the next capture
+    @return     float: the next focus distance, or None once the search is finished
+    '''
+    def proposeNext(self):
+        if self.done:
+            return None
+        for x in self.initial:
+            if x not in self.x_vals:
+                return x
+        if len(self.x_vals) >= self.max_captures:
+            self.done = True
+            return None
+
+        low, best, high = self.getBracket()
+        if high - low <= self.tol:
+            self.done = True
+            return None
+
+        candidates = []
+        if self.use_spline:
+            peak = self.getOptimum()[0]
+            if low < peak < high:
+                candidates.append(peak)
+        # Golden-section point in the larger side of the bracket
+        if high - best > best - low:
+            candidates.append(best + (1 - GR)*(high - best))
+        else:
+            candidates.append(best - (1 - GR)*(best - low))
+
+        # Alternate strategies so that the bracket always keeps shrinking
+        if self.strategy == 'spline':
+            self.use_spline = not self.use_spline
+        for x in candidates:
+            x = self.snap(x, low, high)
+            if x is not None and (self.positions is not None or self.isNew(x)):
+                return x
+
+        self.done = True
+        return None
+
+
+'''
+@name       replayFolder
+@brief      drive a controller from a pre-captured sweep, measuring only the
+            frames that it asks for
+@param[in]  folder: String representing path to folder containing images
+            measure: Name of the focus measure in focus_measures
+            kwargs: arguments passed on to AutofocusController
+@return     optimum: the optimum point (x,y)
+            captures: list of (distance, sharpness) in the order they were measured
+'''
+def replayFolder(folder, measure=focus_measures.DEFAULT_MEASURE, **kwargs):
+    stack = focus_stack.LazyFocusStack(folder, measure)
+    distances = stack.distances
+    if not distances:
+        raise ValueError('No images found in %s' % folder)
+    controller = AutofocusController(distances[0], distances[-1], positions=distances, **kwargs)
+
+    captures = []
+    while True:
+        distance = controller.proposeNext()
+        if distance is None:
+            break
+        sharpness = stack(distance)
+        controller.addMeasurement(distance, sharpness)
+        captures.append((distance, sharpness))
+    return controller.getOptimum(), captures
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    subject_name = '111'
+    if len(sys.argv) > 1:
+        subject_name = sys.argv[1]
+    optimum, captures = replayFolder(os.path.join('RTImg', subject_name))
+    print('Captured %d frames: %s' % (len(captures), [c[0] for c in captures]))
+    print('X: %f, Y: %f' % optimum)
+    sys.exit()
@@ -0,0 +1,411 @@
+'''
+@name    autofocus_service.py
+@brief   Resident autofocus service. Keeps the interpreter, OpenCV, the focus
+         measures, the spline factorizations and the measured sharpness values warm
+         between requests, so an autofocus decision does not pay process start-up,
+         imports and folder scanning every time. Requests are JSON over local HTTP,
+         on a TCP port or a Unix socket:
+
+             POST /focus  {"folder": "RTImg/111"}
+             POST /focus  {"frames": [{"distance": 111, "path": "RTImg/111/..."}, ...]}
+             POST /focus  {"frames": [{"distance": 111, "image": "<base64 JPEG/PNG>"}, ...]}
+             POST /focus  {"frames": [{"distance": 111, "shape": [h, w],
+                                       "pixels": "<base64 uint8 grayscale>"}, ...]}
+             GET  /health
+
+         with optional "measure", "roi" and "downscale" as in sharpness_calc.
+         The response holds the optimal focus distance and its sharpness. Frames are
+         decoded and measured on a bounded pool of worker threads, and identical
+         requests arriving while one is in progress wait for the same result
+@author  Russell Wong, 2017
+'''
+
+import sys, os, stat, time, json, base64, hashlib, argparse, threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+import img_util, sharpness_calc, focus_measures, folder_index, spline_fitter, spline_optimizer
+import instrumentation, lazy_import
+
+cv2 = lazy_import.LazyModule('cv2')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = sharpness_calc.DEFAULT_WORKERS
+# Sharpness values kept in memory before the least recently used are evicted
+MAX_MEMO_ENTRIES = 100000
+
+'''
+@name       Pending
+@brief      Result of a request which other identical requests can wait for
+'''
+class Pending(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+'''
+@name       measureRawFrame
+@brief      Decodes a frame sent in a request and calculates its sharpness.
+            Defined at module level so that it can be used with a pool
+@param[in]  job: 5-tuple (frame, distance, roi, downscale, measure), where frame is
+                 a dict holding either 'image' (base64 of an encoded image) or
+                 'shape' and 'pixels' (base64 of raw uint8 grayscale pixels)
+@return     (distance, sharpness)
+'''
+def measureRawFrame(job):
+    frame, distance, roi, downscale, measure = job
+    try:
+        data = base64.b64decode(frame['image'] if 'image' in frame else frame['pixels'])
+    except (TypeError, ValueError):
+        raise ValueError('Frame at distance %s is not valid base64' % distance)
+    if not data:
+        raise ValueError('Frame at distance %s has no image data' % distance)
+    if 'image' in frame:
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+        if img is None:
+            raise ValueError('Could not decode the frame at distance %s' % distance)
+    else:
+        shape = tuple(frame['shape'])
+        if len(shape) != 2 or len(data) != shape[0]*shape[1]:
+            raise ValueError('Frame at distance %s does not have shape %s' % (distance, shape))
+        img = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    img = img_util.downscaleImage(img, downscale)
+    if roi is not None:
+        return distance, sharpness_calc.calcRegionSharpness(img, roi, downscale, measure)
+    return distance, focus_measures.calcFocusMeasure(img, measure)
+
+
+'''
+@name       measurePathFrame
+@brief      Decodes an image file and calculates its sharpness.
+            Defined at module level so that it can be used with a pool
+@param[in]  job: 5-tuple (path, distance, roi, downscale, measure)
+@return     (distance, sharpness)
+'''
+def measurePathFrame(job):
+    path, distance, roi, downscale, measure = job
+    result = sharpness_calc.measureImageFile((path, distance, None, roi, downscale, measure))
+    if result is None:
+        raise ValueError('Could not decode %s' % path)
+    return result
+
+
+'''
+@name       AutofocusService
+@brief      Answers focus requests, keeping measured sharpness values and spline
+            factorizations between requests
+@param[in]  workers: Number of frames decoded and measured concurrently
+            cache: sharpness_cache.SharpnessCache to also look up and store results in,
+                   so they survive restarts, or None
+            max_memo_entries: Number of sharpness values kept in memory
+'''
+class AutofocusService(object):
+    def __init__(self, workers=DEFAULT_WORKERS, cache=None, max_memo_entries=MAX_MEMO_ENTRIES):
+        self.pool = ThreadPool(max(1, workers))
+        self.cache = cache
+        self.max_memo_entries = max_memo_entries
+        self.lock = threading.Lock()
+        # Frame key -> sharpness, from least to most recently used
+        self.memo = OrderedDict()
+        # Request key -> Pending, for requests in progress
+        self.pending = {}
+        self.stats = {'requests': 0, 'coalesced': 0, 'frames_measured': 0, 'memo_hits': 0}
+
+    '''
+    @name       getFrames
+    @brief      turn a request into a list of frames to measure
+    @param[in]  request: The decoded JSON request
+                params: JSON string of the measure parameters, part of every frame key
+    @return     frames: List of (key, distance, path or None, raw frame dict or None)
+    '''
+    def getFrames(self, request, params):
+        frames = []
+        if 'folder' in request:
+            if not os.path.isdir(request['folder']):
+                raise ValueError('No such folder: %s' % request['folder'])
+            for distance, path in folder_index.getFrames(request['folder']):
+                frames.append(self.getPathFrame(path, distance, params))
+        elif 'frames' in request:
+            for frame in request['frames']:
+                if 'distance' not in frame:
+                    raise ValueError('Every frame needs a distance')
+                distance = float(frame['distance'])
+                if 'path' in frame:
+                    frames.append(self.getPathFrame(frame['path'], distance, params))
+                elif 'image' in frame or 'pixels' in frame:
+                    data = frame['image'] if 'image' in frame else frame['pixels']
+                    if not data:
+                        raise ValueError('Frame at distance %s has no image data' % distance)
+                    digest = hashlib.sha1(data.encode('ascii') if not isinstance(data, bytes)
+                                          else data).hexdigest()
+                    key = ('raw', digest, tuple(frame.get('shape', ())), params)
+                    frames.append((key, distance, None, frame))
+                else:
+                    raise ValueError('Every frame needs a path, image or pixels')
+        else:
+            raise ValueError('Request needs a folder or frames')
+        if len(frames) < 2:
+            raise ValueError('At least 2 frames are required, got %d' % len(frames))
+        return frames
+
+    '''
+    @name       getPathFrame
+    @brief      build the frame of an image file, keyed so that a modified file
+                is measured again
+    '''
+    def getPathFrame(self, path, distance, params):
+        try:
+            info = os.stat(path)
+        except OSError:
+            raise ValueError('No such image: %s' % path)
+        key = ('path', os.path.abspath(path), info.st_size,
+               getattr(info, 'st_mtime_ns', info.st_mtime), params)
+        return (key, distance, path, None)
+
+    '''
+    @name       measure
+    @brief      find the sharpness of every frame, measuring only frames not seen before
+    @return     points: List of (distance, sharpness), ordered by distance
+    '''
+    def measure(self, frames, measure, roi, downscale):
+        sharpness = {}
+        jobs = []
+        with self.lock:
+            for key, distance, path, raw in frames:
+                if key in self.memo:
+                    self.memo[key] = self.memo.pop(key)
+                    sharpness[key] = self.memo[key]
+                    self.stats['memo_hits'] += 1
+        cache_params = {'roi': roi, 'downscale': downscale}
+        for key, distance, path, raw in frames:
+            if key in sharpness:
+                continue
+            if path is not None and self.cache is not None:
+                value = self.cache.get(path, measure, cache_params)
+                if value is not None:
+                    sharpness[key] = value
+                    continue
+            jobs.append((key, path, raw, (path or raw, distance, roi, downscale, measure)))
+
+        if jobs:
+            path_jobs = [job for job in jobs if job[1] is not None]
+            raw_jobs = [job for job in jobs if job[1] is None]
+            results = self.pool.map(measurePathFrame, [job[3] for job in path_jobs])
+            results += self.pool.map(measureRawFrame, [job[3] for job in raw_jobs])
+            for (key, path, raw, _), (_, value) in zip(path_jobs + raw_jobs, results):
+                sharpness[key] = value
+                if path is not None and self.cache is not None:
+                    self.cache.put(path, measure, cache_params, value)
+            with self.lock:
+                self.stats['frames_measured'] += len(jobs)
+                for key, path, raw, _ in jobs:
+                    self.memo[key] = sharpness[key]
+                while len(self.memo) > self.max_memo_entries:
+                    self.memo.popitem(last=False)
+
+        points = sorted((distance, sharpness[key]) for key, distance, _, _ in frames)
+        for i in range(1, len(points)):
+            if points[i][0] == points[i-1][0]:
+                raise ValueError('Two frames have focus distance %s' % points[i][0])
+        return points
+
+    '''
+    @name       solve
+    @brief      find the optimal focus distance of a request, without coalescing
+    @return     dict: the response
+    '''
+    def solve(self, frames, measure, roi, downscale):
+        start = time.time()
+        points = self.measure(frames, measure, roi, downscale)
+        x_vals = [p[0] for p in points]
+        coefficients = spline_fitter.getFitter(x_vals).fit([p[1] for p in points])
+        distance, sharpness = spline_optimizer.findMaximum(coefficients, x_vals)
+        return {
+            'distance': distance,
+            'sharpness': sharpness,
+            'points': points,
+            'seconds': time.time() - start,
+        }
+
+    '''
+    @name       focus
+    @brief      answer a focus request. Identical requests arriving while one is being
+                solved share its result instead of measuring the frames again
+    @param[in]  request: The decoded JSON request
+    @return     dict: the response
+    '''
+    def focus(self, request):
+        measure = request.get('measure', focus_measures.DEFAULT_MEASURE)
+        focus_measures.getMeasure(measure)
+        roi = request.get('roi')
+        downscale = int(request.get('downscale', 1))
+        if downscale < 1:
+            raise ValueError('downscale must be at least 1')
+        params = json.dumps([measure, roi, downscale], sort_keys=True)
+        frames = self.getFrames(request, params)
+        key = tuple((frame[0], frame[1]) for frame in frames)
+
+        with self.lock:
+            self.stats['requests'] += 1
+            pending = self.pending.get(key)
+            if pending is not None:
+                self.stats['coalesced'] += 1
+                owner = False
+            else:
+                pending = Pending()
+                self.pending[key] = pending
+                owner = True
+        if not owner:
+            return pending.wait()
+
+        try:
+            with instrumentation.timer('service_request'):
+                pending.result = self.solve(frames, measure, roi, downscale)
+        except Exception as e:
+            pending.error = e
+        finally:
+            with self.lock:
+                del self.pending[key]
+            pending.event.set()
+        return pending.wait()
+
+    '''
+    @name       getHealth
+    @brief      report that the service is running, with its counters
+    '''
+    def getHealth(self):
+        with self.lock:
+            health = dict(self.stats)
+            health['memo_entries'] = len(self.memo)
+        health['status'] = 'ok'
+        return health
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+'''
+@name       ServiceRequestHandler
+@brief      HTTP front end of an AutofocusService (the server's service attribute)
+'''
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def sendJSON(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self.sendJSON(200, self.server.service.getHealth())
+        else:
+            self.sendJSON(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/focus':
+            self.sendJSON(404, {'error': 'Unknown path %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(request, dict):
+                raise ValueError('Request must be a JSON object')
+            self.sendJSON(200, self.server.service.focus(request))
+        except ValueError as e:
+            self.sendJSON(400, {'error': str(e)})
+        except Exception as e:
+            self.sendJSON(500, {'error': '%s: %s' % (type(e).__name__, e)})
+
+    # Unix socket clients have no address
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        instrumentation.logger.debug('%s %s', self.address_string(), format % args)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+'''
+@name       makeServer
+@brief      Creates the HTTP server of an AutofocusService
+@param[in]  service: The AutofocusService
+@param[in]  host, port: Address to listen on over TCP
+@param[in]  socket_path: Path of a Unix socket to listen on instead, or None. A stale
+                         socket left at that path is replaced, any other file is not
+@return     server: Call serve_forever() to start answering requests
+'''
+def makeServer(service, host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None):
+    if socket_path is not None:
+        if os.path.lexists(socket_path):
+            if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+                raise ValueError('%s exists and is not a socket' % socket_path)
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, ServiceRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.service = service
+    return server
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resident autofocus service')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--socket', default=None, help='Listen on a Unix socket instead')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--cache', default=None, help='SQLite sharpness cache file')
+    args = parser.parse_args()
+
+    cache = None
+    if args.cache is not None:
+        import sharpness_cache
+        cache = sharpness_cache.SharpnessCache(args.cache)
+    service = AutofocusService(args.workers, cache)
+    server = makeServer(service, args.host, args.port, args.socket)
+    print('Listening on %s' % (args.socket or '%s:%d' % (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if cache is not None:
+            cache.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+    sys.exit()
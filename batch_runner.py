@@ -0,0 +1,184 @@
+'''
+@name    batch_runner.py
+@brief   Headless batch entry point which runs the full autofocus pipeline
+         (load, sharpness, spline, optimize) for many subjects at once on a
+         process pool and writes a single CSV or JSON table of the results,
+         optionally rendering each subject's plot off-screen
+@author  Russell Wong, 2017
+'''
+
+import sys, os, time, json, csv, glob, argparse, logging, multiprocessing
+
+import img_util, plot_renderer, sharpness_calc, cubic_spline, spline_fitter, spline_optimizer, focus_measures, folder_index, instrumentation
+
+FIELDS = ['subject', 'folder', 'num_images', 'focus_distance', 'sharpness',
+          'load_seconds', 'sharpness_seconds', 'spline_seconds', 'optimize_seconds',
+          'plot_seconds', 'error']
+
+'''
+@name       findSubjects
+@brief      Expands subject names, folders and glob patterns into subject folders
+@param[in]  patterns: List of subject names (e.g. '111'), folders or glob patterns
+@return     folders: Sorted list of subject folders
+'''
+def findSubjects(patterns):
+    folders = set()
+    for pattern in patterns:
+        if not os.path.isdir(pattern) and not glob.has_magic(pattern):
+            pattern = os.path.join(sharpness_calc.DEFAULT_IMG_DIR, pattern)
+        folders.update(f for f in glob.glob(pattern) if os.path.isdir(f))
+    return sorted(folders)
+
+
+'''
+@name       processSubject
+@brief      Runs the autofocus pipeline on one subject folder, timing each stage.
+            Images are decoded and measured one at a time so only one is held in memory
+@param[in]  job: 6-tuple (folder, measure, plot_dir, num_knots, smoothing, coarse_to_fine),
+                 where plot_dir is the folder to render the plot to, or None to skip
+                 plotting, num_knots is the number of knots of a smoothing spline, or None
+                 to interpolate every image, and coarse_to_fine selects
+                 sharpness_calc.getPointsCoarseToFine, which only measures the frames
+                 around the peak at full resolution
+@return     dict: One row of the result table
+'''
+def processSubject(job):
+    folder, measure, plot_dir, num_knots, smoothing, coarse_to_fine = job
+    subject = os.path.basename(os.path.normpath(folder))
+    row = dict((field, None) for field in FIELDS)
+    row['subject'] = subject
+    row['folder'] = folder
+    try:
+        load_seconds = 0.0
+        sharpness_seconds = 0.0
+        points = []
+        if coarse_to_fine:
+            # Decoding is not timed separately, so it is included in sharpness_seconds
+            start = time.time()
+            points = sharpness_calc.getPointsCoarseToFine(folder, workers=1, measure=measure)
+            load_seconds = None
+            sharpness_seconds = time.time() - start
+        else:
+            for distance, path in folder_index.getFrames(folder):
+                start = time.time()
+                img = img_util.readImageBW(path)
+                load_seconds += time.time() - start
+                if img is None:
+                    continue
+                start = time.time()
+                points.append((distance, focus_measures.calcFocusMeasure(img, measure)))
+                sharpness_seconds += time.time() - start
+        points.sort()
+        row['num_images'] = len(points)
+        row['load_seconds'] = load_seconds
+        row['sharpness_seconds'] = sharpness_seconds
+        if len(points) < 2:
+            raise ValueError('Not enough images in %s' % folder)
+
+        x_vals = [p[0] for p in points]
+        start = time.time()
+        if num_knots is None:
+            coefficients = cubic_spline.getCoefficients(points)
+            knots = x_vals
+        else:
+            fitter = spline_fitter.SmoothingSplineFitter(x_vals, num_knots, smoothing)
+            coefficients = fitter.fit([p[1] for p in points])
+            knots = fitter.knots
+        row['spline_seconds'] = time.time() - start
+
+        start = time.time()
+        opt = spline_optimizer.findMaximum(coefficients, knots)
+        row['optimize_seconds'] = time.time() - start
+        row['focus_distance'], row['sharpness'] = opt
+
+        if plot_dir is not None:
+            start = time.time()
+            plot_renderer.renderCubic(os.path.join(plot_dir, subject + '.png'), coefficients, knots,
+                                      'Cubic Spline for Subject #' + subject, opt[0], opt[1], points)
+            row['plot_seconds'] = time.time() - start
+    except Exception as e:
+        row['error'] = '%s: %s' % (type(e).__name__, e)
+    return row
+
+
+'''
+@name       runBatch
+@brief      Runs the autofocus pipeline on many subject folders on a process pool
+@param[in]  folders: List of subject folders
+@param[in]  measure: Name of the focus measure in focus_measures
+@param[in]  plot_dir: Folder to render plots to, or None to skip plotting
+@param[in]  workers: Number of subjects processed concurrently
+@param[in]  num_knots: Number of knots of a smoothing spline, or None to interpolate
+@param[in]  smoothing: Weight of the curvature penalty of the smoothing spline
+@param[in]  coarse_to_fine: Whether to measure only the frames around a coarse peak
+                            at full resolution
+@return     rows: List of result rows, in the order of folders
+'''
+def runBatch(folders, measure=focus_measures.DEFAULT_MEASURE, plot_dir=None,
+             workers=sharpness_calc.DEFAULT_WORKERS, num_knots=None, smoothing=0.0,
+             coarse_to_fine=False):
+    focus_measures.getMeasure(measure)
+    if plot_dir is not None and not os.path.isdir(plot_dir):
+        os.makedirs(plot_dir)
+    jobs = [(folder, measure, plot_dir, num_knots, smoothing, coarse_to_fine) for folder in folders]
+    pool = multiprocessing.Pool(max(1, min(workers, len(jobs))), instrumentation.initWorker,
+                                instrumentation.getWorkerState())
+    try:
+        rows = list(instrumentation.mergeResults(
+            pool.map(instrumentation.WorkerJob(processSubject), jobs)))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return rows
+
+
+'''
+@name       writeResults
+@brief      Writes the result table to a file
+@param[in]  rows: List of result rows from runBatch
+@param[in]  name: String representing path of the output file, whose
+                  extension (.csv or .json) selects the format
+'''
+def writeResults(rows, name):
+    if name.lower().endswith('.json'):
+        with open(name, 'w') as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+        return
+    with open(name, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the autofocus pipeline on many subjects')
+    parser.add_argument('subjects', nargs='*', default=[os.path.join(sharpness_calc.DEFAULT_IMG_DIR, '*')],
+                        help='Subject names, folders or glob patterns (default: every subject)')
+    parser.add_argument('--output', default='results.csv', help='Output .csv or .json file')
+    parser.add_argument('--plots', default=None, help='Folder to render plots to')
+    parser.add_argument('--measure', default=focus_measures.DEFAULT_MEASURE,
+                        choices=sorted(focus_measures.FOCUS_MEASURES))
+    parser.add_argument('--workers', type=int, default=sharpness_calc.DEFAULT_WORKERS)
+    parser.add_argument('--knots', type=int, default=None,
+                        help='Fit a smoothing spline with this many knots instead of interpolating')
+    parser.add_argument('--smoothing', type=float, default=0.0,
+                        help='Curvature penalty of the smoothing spline')
+    parser.add_argument('--coarse-to-fine', action='store_true',
+                        help='Score every image downscaled and only rescore the images '
+                             'around the coarse peak at full resolution')
+    args = parser.parse_args()
+
+    folders = findSubjects(args.subjects)
+    rows = runBatch(folders, args.measure, args.plots, args.workers, args.knots, args.smoothing,
+                    args.coarse_to_fine)
+    writeResults(rows, args.output)
+    for row in rows:
+        if row['error'] is not None:
+            instrumentation.report('%s: %s' % (row['subject'], row['error']), logging.WARNING)
+        else:
+            instrumentation.report('%s: X: %f, Y: %f' % (row['subject'], row['focus_distance'], row['sharpness']))
+    sys.exit()
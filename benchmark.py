@@ -0,0 +1,270 @@
+'''
+@name    benchmark.py
+@brief   Headless benchmark of the autofocus pipeline using synthetic focus stacks.
+         A textured image is blurred with a Gaussian whose sigma grows with the
+         distance from a known focus distance, each stage of the pipeline is timed
+         separately and the recovered peak is compared against the true one.
+         Results are written to JSON so they can be compared between commits
+@author  Russell Wong, 2017
+'''
+
+import sys, os, ast, time, json, shutil, tempfile, argparse, subprocess
+import cv2
+import numpy as np
+
+import img_util, sharpness_calc, cubic_spline, gaussian_elimination
+import golden_section, spline_optimizer
+
+DEFAULT_SIZES = [(480, 640), (1200, 1600)]
+DEFAULT_NUM_POINTS = [10, 40, 160]
+DEFAULT_OUTPUT = 'benchmark.json'
+# Modules which must import with only NumPy, so short-lived command line
+# invocations that just solve a spline start quickly
+NUMERICAL_CORE = ['cubic_spline', 'thomas_algorithm', 'gaussian_elimination', 'gauss_seidel',
+                  'spline_fitter', 'spline_function', 'spline_optimizer']
+STARTUP_MODULES = NUMERICAL_CORE + ['img_util', 'sharpness_calc', 'golden_section', 'batch_runner']
+# Modules which should only be imported on first use
+HEAVY_MODULES = ['cv2', 'matplotlib']
+STARTUP_REPEATS = 5
+MIN_DISTANCE = 100
+MAX_DISTANCE = 1500
+# Blur sigma in pixels of a perfectly focused frame, and added per mm of
+# defocus for a 1000 pixel wide image
+BASE_BLUR = 0.5
+BLUR_PER_MM = 0.02
+
+'''
+@name       makeTexture
+@brief      Creates a textured grayscale image with detail at several scales
+@param[in]  size: (height, width) of the image
+@param[in]  rng: np.random.RandomState used to generate the texture
+@return     np.array: uint8 image
+'''
+def makeTexture(size, rng):
+    height, width = size
+    img = np.zeros(size, dtype=np.float64)
+    for scale in (1, 4, 16):
+        noise = rng.rand(max(1, height // scale), max(1, width // scale))
+        img += cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR)
+    img = 255 * (img - img.min()) / (img.max() - img.min())
+    return img.astype(np.uint8)
+
+
+'''
+@name       makeFocusStack
+@brief      Writes a synthetic focus stack to a folder using the RTImg naming scheme
+@param[in]  folder: Folder to write the images to
+@param[in]  size: (height, width) of the images
+@param[in]  num_points: Number of focus distances in the sweep
+@param[in]  peak: Focus distance at which the image is sharpest
+@param[in]  rng: np.random.RandomState used to generate the texture
+@return     distances: List of focus distances in the sweep
+'''
+def makeFocusStack(folder, size, num_points, peak, rng):
+    texture = makeTexture(size, rng)
+    distances = np.linspace(MIN_DISTANCE, MAX_DISTANCE, num_points).round().astype(int)
+    blur_per_mm = BLUR_PER_MM * size[1] / 1000.0
+    for distance in distances:
+        sigma = BASE_BLUR + blur_per_mm * abs(distance - peak)
+        img = cv2.GaussianBlur(texture, (0, 0), sigma)
+        img_util.saveImageBW(os.path.join(folder, '999-%04d-%04d.png' % (peak, distance)), img)
+    return list(distances)
+
+
+'''
+@name       timeStage
+@brief      Times a function call
+@return     result: Return value of the function
+@return     float: Elapsed time in seconds
+'''
+def timeStage(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+'''
+@name       runCase
+@brief      Times every stage of the pipeline on one synthetic focus stack
+@param[in]  size: (height, width) of the images
+@param[in]  num_points: Number of focus distances in the sweep
+@param[in]  seed: Seed for the texture and the true focus distance
+@return     dict: Timings in seconds for each stage and the accuracy of the result
+'''
+def runCase(size, num_points, seed=0):
+    rng = np.random.RandomState(seed)
+    peak = int(rng.uniform(MIN_DISTANCE + 200, MAX_DISTANCE - 200))
+    folder = tempfile.mkdtemp(prefix='af_bench_')
+    try:
+        distances = makeFocusStack(folder, size, num_points, peak, rng)
+        paths = sorted(os.path.join(folder, f) for f in os.listdir(folder))
+
+        timings = {}
+        images, timings['decode'] = timeStage(lambda: [img_util.readImageBW(p) for p in paths])
+        (_, sharpness_vals), timings['getSharpness'] = timeStage(sharpness_calc.getSharpness, images)
+        points = sorted(zip(distances, sharpness_vals))
+        x_vals = [p[0] for p in points]
+
+        (A, b), timings['getAMatrixAndBVector'] = timeStage(cubic_spline.getAMatrixAndBVector, points)
+        coefficients, timings['gaussian_elimination.solve'] = timeStage(gaussian_elimination.solve, A, b)
+        opt, timings['goldenSection'] = timeStage(golden_section.goldenSection,
+                                                  x_vals[0], x_vals[-1], coefficients, x_vals)
+        banded, timings['cubic_spline.getCoefficients'] = timeStage(cubic_spline.getCoefficients, points)
+        analytic, timings['spline_optimizer.findMaximum'] = timeStage(spline_optimizer.findMaximum,
+                                                                      banded, x_vals)
+        bracket, timings['getPointsCoarseToFine'] = timeStage(sharpness_calc.getPointsCoarseToFine,
+                                                              folder)
+        coarse_to_fine = spline_optimizer.findMaximum(cubic_spline.getCoefficients(bracket),
+                                                      [p[0] for p in bracket])
+    finally:
+        shutil.rmtree(folder)
+
+    megapixels = size[0]*size[1] / 1e6
+    return {
+        'height': size[0],
+        'width': size[1],
+        'num_points': num_points,
+        'true_peak': peak,
+        'golden_section_peak': float(opt[0]),
+        'golden_section_error': abs(float(opt[0]) - peak),
+        'analytic_peak': analytic[0],
+        'analytic_error': abs(analytic[0] - peak),
+        'coarse_to_fine_peak': coarse_to_fine[0],
+        'coarse_to_fine_error': abs(coarse_to_fine[0] - peak),
+        'coarse_to_fine_frames': len(bracket),
+        'sample_spacing': float(MAX_DISTANCE - MIN_DISTANCE) / (num_points - 1),
+        'seconds': timings,
+        'seconds_per_megapixel': {
+            'decode': timings['decode'] / (megapixels*num_points),
+            'getSharpness': timings['getSharpness'] / (megapixels*num_points),
+        },
+    }
+
+
+'''
+@name       getCommit
+@brief      Finds the current git commit so results can be tracked between commits
+@return     string: Commit hash, or None outside of a git repository
+'''
+def getCommit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return output.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+'''
+@name       timeImport
+@brief      Times importing a module in a fresh interpreter
+@param[in]  module: Name of the module
+@param[in]  repeats: Number of fresh interpreters, of which the fastest is used
+@return     dict: Seconds for the import and for the whole process, and which of
+            HEAVY_MODULES the import loaded
+'''
+def timeImport(module, repeats=STARTUP_REPEATS):
+    script = ('import sys, time; start = time.time(); import %s; '
+              'print(repr((time.time() - start, [m for m in %r if m in sys.modules])))'
+              % (module, HEAVY_MODULES))
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    import_seconds = float('inf')
+    process_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=cwd)
+        process_seconds = min(process_seconds, time.time() - start)
+        seconds, loaded = ast.literal_eval(output.decode('ascii').strip().splitlines()[-1])
+        import_seconds = min(import_seconds, seconds)
+    return {'import_seconds': import_seconds, 'process_seconds': process_seconds,
+            'loaded': loaded}
+
+
+'''
+@name       runStartupBenchmark
+@brief      Times importing each module in a fresh interpreter, and checks that the
+            numerical core does not load OpenCV or matplotlib
+@param[in]  modules: List of module names
+@param[in]  repeats: Number of fresh interpreters per module
+@return     dict: Benchmark results, where 'failures' lists the NUMERICAL_CORE
+            modules which loaded any of HEAVY_MODULES
+'''
+def runStartupBenchmark(modules=STARTUP_MODULES, repeats=STARTUP_REPEATS):
+    startup = {}
+    failures = []
+    baseline = timeImport('numpy', repeats)
+    for module in modules:
+        startup[module] = timeImport(module, repeats)
+        print('%-22s import %.1f ms, process %.1f ms, loaded: %s'
+              % (module, startup[module]['import_seconds']*1e3,
+                 startup[module]['process_seconds']*1e3, ', '.join(startup[module]['loaded']) or '-'))
+        if module in NUMERICAL_CORE and startup[module]['loaded']:
+            failures.append(module)
+    return {
+        'commit': getCommit(),
+        'timestamp': time.time(),
+        'numpy_baseline': baseline,
+        'startup': startup,
+        'failures': failures,
+    }
+
+
+'''
+@name       runBenchmark
+@brief      Runs every combination of image size and number of points
+@param[in]  sizes: List of (height, width) image sizes
+@param[in]  num_points: List of numbers of focus distances in the sweep
+@param[in]  seed: Seed for the synthetic focus stacks
+@return     dict: Benchmark results
+'''
+def runBenchmark(sizes=DEFAULT_SIZES, num_points=DEFAULT_NUM_POINTS, seed=0):
+    cases = []
+    for size in sizes:
+        for n in num_points:
+            case = runCase(size, n, seed)
+            cases.append(case)
+            print('%dx%d N=%d: %s' % (size[1], size[0], n,
+                  ', '.join('%s %.4fs' % item for item in sorted(case['seconds'].items()))))
+    return {
+        'commit': getCommit(),
+        'timestamp': time.time(),
+        'opencv_version': cv2.__version__,
+        'numpy_version': np.__version__,
+        'cases': cases,
+    }
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', nargs='+', default=['%dx%d' % (w, h) for h, w in DEFAULT_SIZES],
+                        help='Image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--points', nargs='+', type=int, default=DEFAULT_NUM_POINTS,
+                        help='Numbers of focus distances in the sweep')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='JSON file to write results to')
+    parser.add_argument('--startup', action='store_true',
+                        help='Time module imports instead, failing if the numerical core loads '
+                             'OpenCV or matplotlib')
+    args = parser.parse_args()
+
+    if args.startup:
+        results = runStartupBenchmark()
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        if results['failures']:
+            print('Loaded OpenCV or matplotlib at import: %s' % ', '.join(results['failures']))
+            sys.exit(1)
+        sys.exit()
+
+    sizes = []
+    for size in args.sizes:
+        width, height = size.lower().split('x')
+        sizes.append((int(height), int(width)))
+    results = runBenchmark(sizes, args.points, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    sys.exit()
@@ -7,10 +7,10 @@
 @author  Russell Wong, 2017
 '''
 
-import sys, os, math, cv2
+import sys, os, math
 import numpy as np
 
-import img_util
+import thomas_algorithm, instrumentation
 
 '''
 @name       getAMatrixAndBVector
@@ -23,10 +23,10 @@ import img_util
 '''
 
 # Assumes points are ordered by x-value
+@instrumentation.timed('matrix_assembly')
 def getAMatrixAndBVector(points):
     if len(points) <= 1:
-        print 'Not enough points!\n'
-        return [[],[]]
+        raise ValueError('Not enough points to fit a spline')
 
     # Extract x and y values
     x = [p[0] for p in points]
@@ -105,10 +105,111 @@ def getAMatrixAndBVector(points):
 
     return A,b
 
+
+'''
+@name       getTridiagonalSystem
+@brief      define the tridiagonal system for the second derivatives M
+            of a natural cubic spline at each of the N points
+            h[i-1]*M[i-1] + 2*(h[i-1]+h[i])*M[i] + h[i]*M[i+1] = 6*(s[i] - s[i-1])
+            where h[i] is the width and s[i] the slope of interval i,
+            and M[0] = M[N-1] = 0 are the natural end conditions
+@param[in]  x: focus distances of the data points (ordered, length N)
+            y: sharpness values of the data points, either of shape (N,)
+               or (N,k) for k sharpness profiles at the same focus distances
+@return     lower, diag, upper: the three diagonals of the system (length N)
+            rhs: the right-hand side of the system
+'''
+@instrumentation.timed('matrix_assembly')
+def getTridiagonalSystem(x, y):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    N = len(x)
+    h = np.diff(x)
+    slopes = np.diff(y, axis=0) / h.reshape((-1,) + (1,)*(y.ndim-1))
+
+    lower = np.zeros(N)
+    diag = np.ones(N)
+    upper = np.zeros(N)
+    rhs = np.zeros(y.shape)
+
+    # Interior rows enforce continuity of the first derivative,
+    # the first and last rows are simply M = 0
+    lower[1:N-1] = h[:-1]
+    diag[1:N-1] = 2*(h[:-1] + h[1:])
+    upper[1:N-1] = h[1:]
+    rhs[1:N-1] = 6*(slopes[1:] - slopes[:-1])
+
+    return lower, diag, upper, rhs
+
+
+'''
+@name       getCoefficientsFromSecondDerivatives
+@brief      convert the second derivatives M of a cubic spline into the
+            a,b,c,d coefficients of ax^3 + bx^2 + cx + d for each interval,
+            laid out as the solution of getAMatrixAndBVector
+@param[in]  x: focus distances of the data points (ordered, length N)
+            y: sharpness values of the data points, (N,) or (N,k)
+            M: second derivatives of the spline at each point, same shape as y
+@return     coefficients: vector of 4*(N-1) coefficients, (4*(N-1),1) or (4*(N-1),k)
+'''
+@instrumentation.timed('coefficient_conversion')
+def getCoefficientsFromSecondDerivatives(x, y, M):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    M = np.asarray(M, dtype=np.float64)
+    n = len(x) - 1
+    shape = (-1,) + (1,)*(y.ndim-1)
+    h = np.diff(x).reshape(shape)
+    x0 = x[:-1].reshape(shape)
+    x1 = x[1:].reshape(shape)
+
+    # On [x0,x1] the spline is
+    #   S(x) = p*(x1-x)^3 + q*(x-x0)^3 + r*(x1-x) + s*(x-x0)
+    p = M[:-1] / (6*h)
+    q = M[1:] / (6*h)
+    r = y[:-1]/h - M[:-1]*h/6
+    s = y[1:]/h - M[1:]*h/6
+
+    # Expand S(x) in powers of x
+    coefficients = np.zeros((n, 4) + y.shape[1:])
+    coefficients[:,0] = q - p
+    coefficients[:,1] = 3*(p*x1 - q*x0)
+    coefficients[:,2] = 3*(q*x0**2 - p*x1**2) - r + s
+    coefficients[:,3] = p*x1**3 - q*x0**3 + r*x1 - s*x0
+
+    if y.ndim == 1:
+        return coefficients.reshape((4*n, 1))
+    return coefficients.reshape((4*n,) + y.shape[1:])
+
+
+'''
+@name       getCoefficients
+@brief      solve for the coefficients of a natural cubic spline through the
+            given points using the O(N) tridiagonal system in the second
+            derivatives instead of the dense 4*(N-1) system
+@param[in]  points: data points (focus distance, sharpness)
+                    extracted from images loaded
+@return     coefficients: vector of a,b,c,d coefficients for each cubic function,
+                          identical in layout to solving getAMatrixAndBVector
+'''
+# Assumes points are ordered by x-value
+def getCoefficients(points):
+    if len(points) <= 1:
+        raise ValueError('Not enough points to fit a spline')
+
+    x = [p[0] for p in points]
+    y = [p[1] for p in points]
+    lower, diag, upper, rhs = getTridiagonalSystem(x, y)
+    M = thomas_algorithm.solve(lower, diag, upper, rhs)
+    return getCoefficientsFromSecondDerivatives(x, y, M)
+
+
 if __name__ == '__main__':
     sample_points = [(0,0),(1,3),(2,1),(4,5)]
     A,b = getAMatrixAndBVector(sample_points)
     print A
     print b
+    print getCoefficients(sample_points)
+    import img_util
     img_util.plotPoints(sample_points, 'Points')
     sys.exit()
\ No newline at end of file
@@ -0,0 +1,130 @@
+'''
+@name    focus_map.py
+@brief   Splits every frame of a focus sweep into a grid of tiles and finds the
+         sharpest focus distance of each tile, giving multi-point autofocus and a
+         coarse depth-from-focus map. Each frame is convolved once; the squared
+         derivative is summed per tile with an integral image, and the splines of
+         all tiles are fitted and maximized together
+@author  Russell Wong, 2017
+'''
+
+import sys, os
+from multiprocessing.pool import ThreadPool
+import numpy as np
+
+import img_util, sharpness_calc, folder_index, spline_fitter, spline_optimizer, lazy_import
+
+cv2 = lazy_import.LazyModule('cv2')
+
+DEFAULT_GRID = (4, 4)
+
+'''
+@name       getTileEdges
+@brief      Splits a length into nearly equal tiles
+@param[in]  length: Number of pixels
+@param[in]  count: Number of tiles
+@return     np.array: count+1 pixel offsets of the tile edges
+'''
+def getTileEdges(length, count):
+    if count < 1 or count > length:
+        raise ValueError('Cannot split %d pixels into %d tiles' % (length, count))
+    return np.linspace(0, length, count + 1).astype(np.intp)
+
+
+'''
+@name       calcTileSharpness
+@brief      Calculates the sharpness of every tile of an image, the L2-Norm of the
+            derivative in the x direction over the tile as in sharpness_calc.calcSharpness
+@param[in]  img: A uint8 grayscale image
+@param[in]  grid: (rows, columns) of tiles
+@return     np.array: Sharpness of each tile, of shape grid
+'''
+def calcTileSharpness(img, grid=DEFAULT_GRID):
+    derivative = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=sharpness_calc.SOBEL_KSIZE)
+    squared = cv2.multiply(derivative, derivative)
+    # integral has one more row and column than the image, with integral[y,x]
+    # the sum of squared[:y,:x]
+    integral = cv2.integral(squared, sdepth=cv2.CV_64F)
+    rows = getTileEdges(img.shape[0], grid[0])
+    cols = getTileEdges(img.shape[1], grid[1])
+    corners = integral[np.ix_(rows, cols)]
+    sums = corners[1:,1:] - corners[:-1,1:] - corners[1:,:-1] + corners[:-1,:-1]
+    return np.sqrt(np.maximum(sums, 0))
+
+
+'''
+@name       measureTiles
+@brief      Decodes a single image file and calculates the sharpness of its tiles.
+            Defined at module level so that it can be used with a pool
+@param[in]  job: 3-tuple (path, grid, downscale)
+@return     np.array of shape grid, or None if the file is not an image
+'''
+def measureTiles(job):
+    path, grid, downscale = job
+    img = img_util.readImageBW(path, downscale=downscale)
+    if img is None:
+        return None
+    return calcTileSharpness(img, grid)
+
+
+'''
+@name       getTileSharpness
+@brief      Calculates the sharpness of every tile of every frame in a folder
+@param[in]  folder: String representing path to folder containing images
+@param[in]  grid: (rows, columns) of tiles
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  workers: Number of images processed concurrently
+@return     distances: np.array of the focus distance of each frame, shape (N,)
+@return     tiles: np.array of the sharpness of each tile, shape (N, rows, columns)
+'''
+def getTileSharpness(folder=sharpness_calc.DEFAULT_IMG_DIR, grid=DEFAULT_GRID, downscale=1,
+                     workers=sharpness_calc.DEFAULT_WORKERS):
+    frames = folder_index.getFrames(folder)
+    jobs = [(path, tuple(grid), downscale) for _, path in frames]
+    distances = []
+    tiles = []
+    pool = ThreadPool(max(1, min(workers, len(jobs))))
+    try:
+        for (distance, _), result in zip(frames, pool.imap(measureTiles, jobs)):
+            if result is not None:
+                distances.append(distance)
+                tiles.append(result)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if not tiles:
+        return np.zeros(0), np.zeros((0,) + tuple(grid))
+    return np.array(distances, dtype=np.float64), np.array(tiles)
+
+
+'''
+@name       getFocusMap
+@brief      Finds the sharpest focus distance of every tile, fitting one natural cubic
+            spline per tile through the same focus distances in a single solve
+@param[in]  distances: Focus distance of each frame, shape (N,), strictly increasing
+@param[in]  tiles: Sharpness of each tile, shape (N, rows, columns)
+@return     focus: np.array of the optimum focus distance of each tile, shape (rows, columns)
+@return     sharpness: np.array of the sharpness at that distance, shape (rows, columns)
+'''
+def getFocusMap(distances, tiles):
+    distances = np.asarray(distances, dtype=np.float64)
+    tiles = np.asarray(tiles, dtype=np.float64)
+    grid = tiles.shape[1:]
+    coefficients = spline_fitter.getFitter(distances).fit(tiles.reshape((len(distances), -1)))
+    focus, sharpness = spline_optimizer.findMaxima(coefficients, distances)
+    return focus.reshape(grid), sharpness.reshape(grid)
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    subject_name = '111'
+    if len(sys.argv) > 1:
+        subject_name = sys.argv[1]
+    distances, tiles = getTileSharpness(os.path.join(sharpness_calc.DEFAULT_IMG_DIR, subject_name))
+    focus, sharpness = getFocusMap(distances, tiles)
+    print('Best focus distance per tile:')
+    print(np.array2string(focus, precision=1))
+    sys.exit()
@@ -0,0 +1,164 @@
+'''
+@name    focus_measures.py
+@brief   Registry of focus measures which reduce a grayscale image to a single
+         sharpness value, selectable by name. All measures take a uint8
+         grayscale image and return a float which is larger for sharper images
+@author  Russell Wong, 2017
+'''
+
+import sys, time
+import numpy as np
+
+import instrumentation, lazy_import
+
+cv2 = lazy_import.LazyModule('cv2')
+
+DEFAULT_MEASURE = 'sobel_x'
+
+'''
+@name       sobelX
+@brief      L2-Norm of the derivative in the x direction (5x5 Sobel, 64-bit float),
+            the original sharpness measure
+'''
+def sobelX(img):
+    return cv2.norm(cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=5))
+
+
+'''
+@name       sobelX16S
+@brief      sobelX computed with a 16-bit integer derivative. For uint8 images the
+            5x5 Sobel cannot exceed 48*255 in magnitude, so the result is identical
+            to sobelX at a quarter of the memory traffic
+'''
+def sobelX16S(img):
+    return cv2.norm(cv2.Sobel(img, cv2.CV_16S, 1, 0, ksize=5))
+
+
+'''
+@name       sobelX32F
+@brief      sobelX computed with a 32-bit float derivative, for images that are
+            not uint8
+'''
+def sobelX32F(img):
+    return cv2.norm(cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=5))
+
+
+'''
+@name       tenengrad
+@brief      L2-Norm of the gradient magnitude in both the x and y directions (3x3 Sobel)
+'''
+def tenengrad(img):
+    gx = cv2.norm(cv2.Sobel(img, cv2.CV_16S, 1, 0, ksize=3), cv2.NORM_L2SQR)
+    gy = cv2.norm(cv2.Sobel(img, cv2.CV_16S, 0, 1, ksize=3), cv2.NORM_L2SQR)
+    return np.sqrt(gx + gy)
+
+
+'''
+@name       laplacianVariance
+@brief      Variance of the Laplacian of the image
+'''
+def laplacianVariance(img):
+    mean, stddev = cv2.meanStdDev(cv2.Laplacian(img, cv2.CV_16S))
+    return float(stddev[0,0])**2
+
+
+'''
+@name       brenner
+@brief      Brenner gradient, the sum of squared differences between pixels
+            two columns apart
+'''
+def brenner(img):
+    return cv2.norm(img[:,2:], img[:,:-2], cv2.NORM_L2SQR)
+
+
+'''
+@name       normalizedVariance
+@brief      Variance of the image intensity divided by its mean, which
+            compensates for differences in exposure between frames
+'''
+def normalizedVariance(img):
+    mean, stddev = cv2.meanStdDev(img)
+    mean = float(mean[0,0])
+    if mean == 0:
+        return 0.0
+    return float(stddev[0,0])**2 / mean
+
+
+# Focus measures by name
+FOCUS_MEASURES = {
+    'sobel_x': sobelX,
+    'sobel_x_16s': sobelX16S,
+    'sobel_x_32f': sobelX32F,
+    'tenengrad': tenengrad,
+    'laplacian_var': laplacianVariance,
+    'brenner': brenner,
+    'normalized_var': normalizedVariance,
+}
+
+
+'''
+@name       getMeasure
+@brief      Looks up a focus measure by name
+@param[in]  name: Name of the focus measure
+@return     function: Function taking a grayscale image and returning its sharpness
+'''
+def getMeasure(name):
+    try:
+        return FOCUS_MEASURES[name]
+    except KeyError:
+        raise ValueError('Unknown focus measure %r, expected one of %s'
+                         % (name, ', '.join(sorted(FOCUS_MEASURES))))
+
+
+'''
+@name       calcFocusMeasure
+@brief      Calculates the sharpness of an image with a focus measure
+@param[in]  img: A grayscale image
+@param[in]  name: Name of the focus measure
+@return     float: The calculated sharpness value
+'''
+@instrumentation.timed('focus_measure')
+def calcFocusMeasure(img, name=DEFAULT_MEASURE):
+    return float(getMeasure(name)(img))
+
+
+'''
+@name       getCostPerMegapixel
+@brief      Times a focus measure on a textured test image
+@param[in]  name: Name of the focus measure
+@param[in]  size: (height, width) of the test image
+@param[in]  repeats: Number of timed runs, of which the fastest is used
+@return     float: Seconds per megapixel
+'''
+def getCostPerMegapixel(name, size=(1000, 1000), repeats=5):
+    measure = getMeasure(name)
+    img = np.random.RandomState(0).randint(0, 256, size).astype(np.uint8)
+    img = cv2.GaussianBlur(img, (0, 0), 1.5)
+    measure(img)
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        measure(img)
+        best = min(best, time.time() - start)
+    return best / (size[0]*size[1] / 1e6)
+
+
+'''
+@name       getCosts
+@brief      Times every registered focus measure
+@param[in]  size: (height, width) of the test image
+@param[in]  repeats: Number of timed runs per measure
+@return     costs: List of (name, seconds per megapixel), cheapest first
+'''
+def getCosts(size=(1000, 1000), repeats=5):
+    costs = [(name, getCostPerMegapixel(name, size, repeats)) for name in FOCUS_MEASURES]
+    return sorted(costs, key=lambda cost: cost[1])
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    for name, cost in getCosts():
+        print('%-16s %.2f ms/MP' % (name, cost*1e3))
+    sys.exit()
@@ -0,0 +1,159 @@
+'''
+@name    focus_stack.py
+@brief   Lazy view of a subject folder as a function of focus distance to sharpness.
+         A frame is only decoded and measured the first time its focus distance
+         (or the nearest captured distance) is requested, so a search that narrows
+         towards the peak only ever touches the frames it visits
+@author  Yun-Ha Jung, Russell Wong, 2017
+'''
+
+import sys, os, math, bisect
+import numpy as np
+
+import img_util, focus_measures, folder_index, sharpness_calc, cubic_spline, spline_optimizer
+
+GR = (math.sqrt(5) - 1)/2
+
+'''
+@name       LazyFocusStack
+@brief      Memoized mapping of focus distance to sharpness over a subject folder
+@param[in]  folder: String representing path to folder containing images
+            measure: Name of the focus measure in focus_measures
+            roi: Region of interest as in sharpness_calc.calcRegionSharpness, or None
+            downscale: Integer factor to shrink the images by while decoding
+            cache: sharpness_cache.SharpnessCache to look up and store results in, or None
+'''
+class LazyFocusStack(object):
+    def __init__(self, folder, measure=focus_measures.DEFAULT_MEASURE, roi=None, downscale=1,
+                 cache=None):
+        focus_measures.getMeasure(measure)
+        frames = folder_index.getFrames(folder)
+        self.distances = [f[0] for f in frames]
+        self.paths = [f[1] for f in frames]
+        self.measure = measure
+        self.roi = roi
+        self.downscale = downscale
+        self.cache = cache
+        # Sharpness of every frame measured so far, by index
+        self.measured = {}
+        # Number of frames actually decoded
+        self.decoded = 0
+
+    def __len__(self):
+        return len(self.distances)
+
+    '''
+    @name       nearestIndex
+    @brief      find the frame captured closest to a focus distance
+    @return     int: index of the frame
+    '''
+    def nearestIndex(self, distance):
+        if not self.distances:
+            raise ValueError('Focus stack is empty')
+        i = bisect.bisect_left(self.distances, distance)
+        if i == len(self.distances):
+            return i - 1
+        if i > 0 and distance - self.distances[i-1] <= self.distances[i] - distance:
+            return i - 1
+        return i
+
+    '''
+    @name       sharpnessAt
+    @brief      measure the sharpness of a frame, decoding it only on the first request
+    @param[in]  i: index of the frame
+    @return     float: the sharpness of the frame
+    '''
+    def sharpnessAt(self, i):
+        if i in self.measured:
+            return self.measured[i]
+        params = {'roi': self.roi, 'downscale': self.downscale}
+        sharpness = None
+        if self.cache is not None:
+            sharpness = self.cache.get(self.paths[i], self.measure, params)
+        if sharpness is None:
+            img = img_util.readImageBW(self.paths[i], downscale=self.downscale)
+            if img is None:
+                raise ValueError('Could not decode %s' % self.paths[i])
+            self.decoded += 1
+            if self.roi is not None:
+                sharpness = sharpness_calc.calcRegionSharpness(img, self.roi, self.downscale,
+                                                               self.measure)
+            else:
+                sharpness = focus_measures.calcFocusMeasure(img, self.measure)
+            if self.cache is not None:
+                self.cache.put(self.paths[i], self.measure, params, sharpness)
+        self.measured[i] = sharpness
+        return sharpness
+
+    '''
+    @name       __call__
+    @brief      measure the sharpness at the frame nearest to a focus distance
+    @param[in]  distance: the focus distance
+    @return     float: the sharpness of the nearest frame
+    '''
+    def __call__(self, distance):
+        return self.sharpnessAt(self.nearestIndex(distance))
+
+    '''
+    @name       getPoints
+    @brief      list the frames measured so far
+    @return     points: List of 2-tuples representing (x,y) coordinates
+    '''
+    def getPoints(self):
+        return [(self.distances[i], self.measured[i]) for i in sorted(self.measured)]
+
+
+'''
+@name       findPeak
+@brief      find the sharpest focus distance of a stack with a golden-section search
+            over frame indices, which measures O(log N) frames for a unimodal
+            sharpness curve, then refine it with a cubic spline through the frames visited
+@param[in]  stack: LazyFocusStack to search
+@return     optimum: the optimum point (x,y)
+'''
+def findPeak(stack):
+    n = len(stack)
+    if n == 0:
+        raise ValueError('Focus stack is empty')
+    low, high = 0, n - 1
+
+    # Narrow [low, high] until only three frames are left
+    while high - low > 2:
+        x1 = low + int(round((1 - GR)*(high - low)))
+        x2 = low + int(round(GR*(high - low)))
+        if x1 == x2:
+            x2 = x1 + 1
+        if stack.sharpnessAt(x1) >= stack.sharpnessAt(x2):
+            high = x2
+        else:
+            low = x1
+
+    best = max(range(low, high + 1), key=stack.sharpnessAt)
+    optimum = (stack.distances[best], stack.sharpnessAt(best))
+
+    points = stack.getPoints()
+    if len(points) < 2:
+        return optimum
+    x_vals = [p[0] for p in points]
+    coefficients = cubic_spline.getCoefficients(points)
+    # Only trust a spline peak between the neighbours of the sharpest frame
+    left = stack.distances[max(best - 1, 0)]
+    right = stack.distances[min(best + 1, n - 1)]
+    for peak in spline_optimizer.findPeaks(coefficients, x_vals):
+        if left <= peak[0] <= right and peak[1] >= optimum[1]:
+            return peak
+    return optimum
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    subject_name = '111'
+    if len(sys.argv) > 1:
+        subject_name = sys.argv[1]
+    stack = LazyFocusStack(os.path.join(sharpness_calc.DEFAULT_IMG_DIR, subject_name))
+    optimum = findPeak(stack)
+    print('Decoded %d of %d frames' % (stack.decoded, len(stack)))
+    print('X: %f, Y: %f' % optimum)
+    sys.exit()
@@ -0,0 +1,218 @@
+'''
+@name    focus_stacking.py
+@brief   Combines a focus sweep into a single all-in-focus image by taking each pixel
+         from the frame where it is locally sharpest (or blending the frames weighted
+         by their local sharpness). Frames are streamed one at a time through a running
+         best-sharpness and best-pixel buffer, so memory stays at a few frames whatever
+         the depth of the stack, and frame stack files can be processed in strips of
+         rows for images larger than memory
+@author  Russell Wong, 2017
+'''
+
+import sys, os
+import numpy as np
+
+import img_util, sharpness_calc, folder_index, frame_stack, lazy_import
+
+cv2 = lazy_import.LazyModule('cv2')
+
+# Side of the square window the squared derivative is averaged over
+DEFAULT_WINDOW = 9
+DEFAULT_MODE = 'select'
+MODES = ('select', 'blend')
+# Rows per strip for stackFile
+DEFAULT_TILE_ROWS = 512
+# Weight every frame gets in 'blend' mode, so flat regions are averaged
+BLEND_EPSILON = 1e-3
+
+'''
+@name       calcLocalSharpness
+@brief      Calculates the sharpness around every pixel of an image, the squared
+            gradient (x and y Sobel derivatives) averaged over a square window
+@param[in]  img: A uint8 grayscale image
+@param[in]  window: Side of the averaging window in pixels
+@return     np.array: float32 local sharpness with the shape of img
+'''
+def calcLocalSharpness(img, window=DEFAULT_WINDOW):
+    gx = cv2.Sobel(img, cv2.CV_32F, 1, 0, ksize=sharpness_calc.SOBEL_KSIZE)
+    gy = cv2.Sobel(img, cv2.CV_32F, 0, 1, ksize=sharpness_calc.SOBEL_KSIZE)
+    energy = cv2.multiply(gx, gx)
+    energy += cv2.multiply(gy, gy)
+    return cv2.boxFilter(energy, -1, (window, window))
+
+
+'''
+@name       getHalo
+@brief      Number of extra rows on each side of a strip that calcLocalSharpness reads
+'''
+def getHalo(window=DEFAULT_WINDOW):
+    return window // 2 + sharpness_calc.SOBEL_BORDER
+
+
+'''
+@name       FocusStacker
+@brief      Running all-in-focus composite of frames of the same shape
+@param[in]  shape: (height, width) of the frames
+            mode: 'select' to take each pixel from its sharpest frame, or 'blend'
+                  to average the frames weighted by their local sharpness
+            window: Side of the window local sharpness is averaged over
+'''
+class FocusStacker(object):
+    def __init__(self, shape, mode=DEFAULT_MODE, window=DEFAULT_WINDOW):
+        if mode not in MODES:
+            raise ValueError('Unknown mode %r, expected one of %s' % (mode, ', '.join(MODES)))
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.window = window
+        self.count = 0
+        if mode == 'select':
+            self.best_sharpness = np.full(self.shape, -1, dtype=np.float32)
+            self.best_pixel = np.zeros(self.shape, dtype=np.uint8)
+            # Index of the frame each pixel was taken from, a coarse depth map
+            self.best_index = np.zeros(self.shape, dtype=np.int32)
+        else:
+            self.weighted_sum = np.zeros(self.shape, dtype=np.float32)
+            self.weight_sum = np.zeros(self.shape, dtype=np.float32)
+
+    '''
+    @name       add
+    @brief      merge the next frame into the composite
+    @param[in]  img: uint8 grayscale frame
+                sharpness: local sharpness of img if already calculated, else None
+    '''
+    def add(self, img, sharpness=None):
+        if img.shape != self.shape:
+            raise ValueError('Frame %d has shape %s, expected %s'
+                             % (self.count, img.shape, self.shape))
+        if sharpness is None:
+            sharpness = calcLocalSharpness(img, self.window)
+        if self.mode == 'select':
+            sharper = sharpness > self.best_sharpness
+            np.copyto(self.best_sharpness, sharpness, where=sharper)
+            np.copyto(self.best_pixel, img, where=sharper)
+            self.best_index[sharper] = self.count
+        else:
+            sharpness += BLEND_EPSILON
+            self.weighted_sum += sharpness*img
+            self.weight_sum += sharpness
+        self.count += 1
+
+    '''
+    @name       getComposite
+    @brief      get the all-in-focus image of the frames added so far
+    @return     np.array: uint8 grayscale image
+    '''
+    def getComposite(self):
+        if self.mode == 'select':
+            return self.best_pixel.copy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            composite = self.weighted_sum / self.weight_sum
+        return np.clip(np.nan_to_num(composite) + 0.5, 0, 255).astype(np.uint8)
+
+    '''
+    @name       getDepthMap
+    @brief      get the index of the frame each pixel was taken from ('select' only)
+    @return     np.array: int32 frame index per pixel
+    '''
+    def getDepthMap(self):
+        if self.mode != 'select':
+            raise ValueError('Depth maps are only kept in select mode')
+        return self.best_index.copy()
+
+
+'''
+@name       stackImages
+@brief      Combines a stream of frames into an all-in-focus image
+@param[in]  images: Iterable of uint8 grayscale frames of the same shape, in
+                    order of focus distance
+@param[in]  mode: 'select' or 'blend'
+@param[in]  window: Side of the window local sharpness is averaged over
+@return     composite: uint8 all-in-focus image, or None if there were no frames
+@return     depth: index of the frame each pixel was taken from, or None in blend mode
+'''
+def stackImages(images, mode=DEFAULT_MODE, window=DEFAULT_WINDOW):
+    stacker = None
+    for img in images:
+        if stacker is None:
+            stacker = FocusStacker(img.shape, mode, window)
+        stacker.add(img)
+    if stacker is None:
+        return None, None
+    depth = stacker.getDepthMap() if mode == 'select' else None
+    return stacker.getComposite(), depth
+
+
+'''
+@name       stackFolder
+@brief      Combines a subject folder into an all-in-focus image, decoding one
+            frame at a time
+@param[in]  folder: String representing path to folder containing images
+@param[in]  mode: 'select' or 'blend'
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@return     composite, depth: as in stackImages
+'''
+def stackFolder(folder, mode=DEFAULT_MODE, downscale=1, window=DEFAULT_WINDOW):
+    def decode():
+        for _, path in folder_index.getFrames(folder):
+            img = img_util.readImageBW(path, downscale=downscale)
+            if img is not None:
+                yield img
+    return stackImages(decode(), mode, window)
+
+
+'''
+@name       stackFile
+@brief      Combines a frame_stack file into an all-in-focus image one strip of rows at
+            a time, reading each strip (with the rows around it that the derivative and
+            averaging window need) from every frame through the memory map. Only one
+            strip of every buffer is in memory at once, so the result matches stackImages
+            while the frames may be larger than memory
+@param[in]  path: String representing path of the stack file
+@param[in]  mode: 'select' or 'blend'
+@param[in]  window: Side of the window local sharpness is averaged over
+@param[in]  tile_rows: Number of rows per strip
+@param[in]  out: uint8 array of the frame shape to write the composite into (e.g. an
+                 np.memmap), or None to allocate one
+@return     np.array: The composite (out if given)
+'''
+def stackFile(path, mode=DEFAULT_MODE, window=DEFAULT_WINDOW, tile_rows=DEFAULT_TILE_ROWS,
+              out=None):
+    _, frames = frame_stack.openStack(path)
+    count, height, width = frames.shape
+    if count == 0:
+        raise ValueError('%s has no frames' % path)
+    if out is None:
+        out = np.empty((height, width), dtype=np.uint8)
+    halo = getHalo(window)
+    for y0 in range(0, height, tile_rows):
+        y1 = min(y0 + tile_rows, height)
+        # Strip with its halo, clipped to the image so its true edges are
+        # handled exactly as for the full frame
+        by0 = max(0, y0 - halo)
+        by1 = min(height, y1 + halo)
+        stacker = FocusStacker((y1 - y0, width), mode, window)
+        for frame in frames:
+            strip = np.ascontiguousarray(frame[by0:by1])
+            sharpness = calcLocalSharpness(strip, window)[y0-by0:y1-by0]
+            stacker.add(strip[y0-by0:y1-by0], sharpness)
+        out[y0:y1] = stacker.getComposite()
+    return out
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: focus_stacking.py <subject folder or stack file> [<output image>] [select|blend]')
+        sys.exit(1)
+    source = sys.argv[1]
+    name = sys.argv[2] if len(sys.argv) > 2 else 'stacked.png'
+    mode = sys.argv[3] if len(sys.argv) > 3 else DEFAULT_MODE
+    if os.path.isfile(source):
+        composite = stackFile(source, mode)
+    else:
+        composite, _ = stackFolder(source, mode)
+    img_util.saveImageBW(name, composite)
+    print('Wrote %s' % name)
+    sys.exit()
@@ -0,0 +1,205 @@
+'''
+@name    folder_index.py
+@brief   Builds a sorted index of focus distance to image path for a subject folder.
+         Focus distances are parsed from the documented NNN-DDDD-FFFF file naming
+         (subject, subject distance, focus distance), falling back to the EXIF
+         SubjectDistance tag, and non-image files are skipped without decoding.
+         The index is saved next to the images and reused until the folder changes
+@author  Russell Wong, 2017
+'''
+
+import sys, os, re, json, struct
+
+INDEX_FILE = '.focus_index.json'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+# NNN-DDDD-FFFF, e.g. 001-550-340.jpeg is subject 001, 550mm away, focused at 340mm
+FILENAME_PATTERN = re.compile(r'^(\d+)-(\d+)-(\d+)\.[A-Za-z]+$')
+# A focus distance of 0 marks the camera's own autofocused image
+AUTOFOCUS_DISTANCE = 0
+
+EXIF_POINTER_TAG = 0x8769
+SUBJECT_DISTANCE_TAG = 0x9206
+RATIONAL_TYPE = 5
+
+'''
+@name       isImageFile
+@brief      Checks whether a file name has an image extension
+'''
+def isImageFile(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+'''
+@name       parseFilename
+@brief      Parses the subject, subject distance and focus distance from a file name
+@param[in]  name: File name such as 001-550-340.jpeg
+@return     (subject, subject_distance, focus_distance), or None if the name does
+            not follow the naming scheme
+'''
+def parseFilename(name):
+    match = FILENAME_PATTERN.match(name)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+'''
+@name       readExifSubjectDistance
+@brief      Reads the SubjectDistance EXIF tag of a JPEG file without decoding it
+@param[in]  path: String representing path to the image
+@return     float: The subject distance in mm, or None if it is not recorded
+'''
+def readExifSubjectDistance(path):
+    with open(path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            return None
+        # Walk the JPEG segments until the EXIF (APP1) segment
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return None
+            marker, length = struct.unpack('>HH', header)
+            if marker == 0xFFE1:
+                segment = f.read(length - 2)
+                if segment[:6] == b'Exif\x00\x00':
+                    return _findSubjectDistance(segment[6:])
+            elif marker in (0xFFDA, 0xFFD9) or (marker >> 8) != 0xFF:
+                # Start of the image data, no EXIF segment
+                return None
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+
+'''
+@name       _findSubjectDistance
+@brief      Finds the SubjectDistance tag in a TIFF structured EXIF block
+'''
+def _findSubjectDistance(tiff):
+    try:
+        order = {b'II': '<', b'MM': '>'}[tiff[:2]]
+        ifd_offset = struct.unpack(order + 'I', tiff[4:8])[0]
+        exif_offset = _findTag(tiff, order, ifd_offset, EXIF_POINTER_TAG)
+        if exif_offset is None:
+            return None
+        value_offset = _findTag(tiff, order, exif_offset[1], SUBJECT_DISTANCE_TAG)
+        if value_offset is None or value_offset[0] != RATIONAL_TYPE:
+            return None
+        numerator, denominator = struct.unpack(order + 'II',
+                                               tiff[value_offset[1]:value_offset[1]+8])
+    except (KeyError, struct.error):
+        return None
+    # 0xFFFFFFFF is infinity and 0 is unknown
+    if denominator == 0 or numerator in (0, 0xFFFFFFFF):
+        return None
+    return 1000.0 * numerator / denominator
+
+
+'''
+@name       _findTag
+@brief      Finds a tag in an IFD of a TIFF structured block
+@return     (type, value or offset) of the tag, or None if it is not in the IFD
+'''
+def _findTag(tiff, order, offset, tag):
+    count = struct.unpack(order + 'H', tiff[offset:offset+2])[0]
+    for i in range(count):
+        entry = tiff[offset+2+12*i:offset+14+12*i]
+        entry_tag, entry_type, _, value = struct.unpack(order + 'HHII', entry)
+        if entry_tag == tag:
+            return entry_type, value
+    return None
+
+
+'''
+@name       getFolderSignature
+@brief      Describes the image files in a folder so a saved index can be checked
+            against the current contents
+@return     list: [name, size, mtime] for every image file, sorted by name
+'''
+def getFolderSignature(folder):
+    signature = []
+    for name in sorted(os.listdir(folder)):
+        if isImageFile(name):
+            stat = os.stat(os.path.join(folder, name))
+            signature.append([name, stat.st_size, stat.st_mtime])
+    return signature
+
+
+'''
+@name       buildIndex
+@brief      Indexes the images in a folder by focus distance without decoding any of them
+@param[in]  folder: String representing path to folder containing images
+@return     dict: 'frames' is a list of [focus distance, file name] sorted by distance,
+            'autofocus' is the file name of the camera's autofocused image (or None) and
+            'signature' is the result of getFolderSignature
+'''
+def buildIndex(folder):
+    signature = getFolderSignature(folder)
+    frames = []
+    autofocus = None
+    for name, _, _ in signature:
+        parsed = parseFilename(name)
+        if parsed is not None:
+            distance = parsed[2]
+        else:
+            distance = readExifSubjectDistance(os.path.join(folder, name))
+            if distance is None:
+                continue
+        if distance == AUTOFOCUS_DISTANCE:
+            autofocus = name
+            continue
+        frames.append([distance, name])
+    frames.sort()
+    return {'frames': frames, 'autofocus': autofocus, 'signature': signature}
+
+
+'''
+@name       loadIndex
+@brief      Loads the saved index of a folder, rebuilding and saving it if the
+            folder's images have changed since it was built
+@param[in]  folder: String representing path to folder containing images
+@param[in]  save: Whether to save a rebuilt index next to the images
+@return     dict: The index as returned by buildIndex
+'''
+def loadIndex(folder, save=True):
+    index_path = os.path.join(folder, INDEX_FILE)
+    signature = getFolderSignature(folder)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('signature') == signature:
+            return index
+    except (IOError, OSError, ValueError):
+        pass
+
+    index = buildIndex(folder)
+    if save:
+        try:
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+        except (IOError, OSError):
+            # The index is only an optimization, e.g. for read-only folders
+            pass
+    return index
+
+
+'''
+@name       getFrames
+@brief      Lists the images in a folder sorted by focus distance
+@param[in]  folder: String representing path to folder containing images
+@return     frames: List of (focus distance, image path)
+'''
+def getFrames(folder):
+    return [(distance, os.path.join(folder, name))
+            for distance, name in loadIndex(folder)['frames']]
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    folder = 'RTImg/111'
+    if len(sys.argv) > 1:
+        folder = sys.argv[1]
+    for distance, path in getFrames(folder):
+        print('%s: %s' % (distance, path))
+    sys.exit()
@@ -0,0 +1,147 @@
+'''
+@name    frame_stack.py
+@brief   Compact container for focus sweeps: a header with the frame shape and the
+         focus distance of every frame, followed by contiguous uint8 grayscale frames.
+         Stacks are opened with np.memmap, so every frame is a zero-copy view of the
+         file and repeated analysis is a sequential read with no decoding
+@author  Russell Wong, 2017
+'''
+
+import sys, os, struct
+import numpy as np
+
+import img_util, folder_index
+
+MAGIC = b'AFSTACK1'
+# Magic, number of frames, frame height, frame width, offset of the first frame
+HEADER_FORMAT = '<8sIIIQ'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Frames start on a page boundary so each one can be mapped efficiently
+ALIGNMENT = 4096
+STACK_EXTENSION = '.afs'
+
+'''
+@name       getDataOffset
+@brief      Calculates where the first frame starts for a number of frames
+'''
+def getDataOffset(num_frames):
+    end = HEADER_SIZE + 8*num_frames
+    return -(-end // ALIGNMENT) * ALIGNMENT
+
+
+'''
+@name       writeStack
+@brief      Writes frames to a stack file one at a time
+@param[in]  path: String representing path of the stack file
+@param[in]  distances: List of focus distances, one per frame
+@param[in]  frames: Iterable of uint8 grayscale frames of the same shape
+'''
+def writeStack(path, distances, frames):
+    distances = np.asarray(distances, dtype='<f8')
+    offset = getDataOffset(len(distances))
+    shape = None
+    count = 0
+    try:
+        with open(path, 'wb') as f:
+            f.seek(offset)
+            for frame in frames:
+                frame = np.ascontiguousarray(frame, dtype=np.uint8)
+                if frame.ndim != 2:
+                    raise ValueError('Frames must be grayscale')
+                if shape is None:
+                    shape = frame.shape
+                elif frame.shape != shape:
+                    raise ValueError('Frame %d has shape %s, expected %s'
+                                     % (count, frame.shape, shape))
+                f.write(frame.tobytes())
+                count += 1
+            if count != len(distances):
+                raise ValueError('Got %d frames for %d distances' % (count, len(distances)))
+            if shape is None:
+                shape = (0, 0)
+            # The header is written last so an interrupted write is never a valid stack
+            f.seek(0)
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, count, shape[0], shape[1], offset))
+            f.write(distances.tobytes())
+    except Exception:
+        os.remove(path)
+        raise
+
+
+'''
+@name       openStack
+@brief      Maps a stack file into memory without reading the frames
+@param[in]  path: String representing path of the stack file
+@return     distances: np.array of focus distances
+@return     frames: read-only np.memmap of shape (frames, height, width)
+'''
+def openStack(path):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError('%s is not a frame stack' % path)
+        magic, count, height, width, offset = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame stack' % path)
+        distances = np.frombuffer(f.read(8*count), dtype='<f8').astype(np.float64)
+    if count == 0:
+        return distances, np.zeros((0, height, width), dtype=np.uint8)
+    frames = np.memmap(path, dtype=np.uint8, mode='r', offset=offset,
+                       shape=(count, height, width))
+    return distances, frames
+
+
+'''
+@name       convertFolder
+@brief      Converts a subject folder of JPEG/PNG images into a stack file. Frames are
+            stored unchanged, so a folder whose frames differ in size is rejected unless
+            shape is given, in which case every frame is resized to it (which changes
+            its sharpness, so the stack no longer measures the same as the folder)
+@param[in]  folder: String representing path to folder containing images
+@param[in]  path: String representing path of the stack file
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  shape: (height, width) to resize every frame to, or None to require
+                   frames of the same shape
+@return     int: Number of frames written
+'''
+def convertFolder(folder, path, downscale=1, shape=None):
+    frames = folder_index.getFrames(folder)
+    distances = [f[0] for f in frames]
+
+    def decode():
+        first_shape = None
+        for _, image_path in frames:
+            img = img_util.readImageBW(image_path, downscale=downscale)
+            if img is None:
+                raise ValueError('Could not decode %s' % image_path)
+            if shape is not None:
+                img = img_util.resizeImage(img, tuple(shape))
+            elif first_shape is None:
+                first_shape = img.shape
+            elif img.shape != first_shape:
+                raise ValueError('%s has shape %s, expected %s; pass shape to resize the frames'
+                                 % (image_path, img.shape, first_shape))
+            yield img
+
+    writeStack(path, distances, decode())
+    return len(distances)
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: frame_stack.py <subject folder> [<stack file>] [<height>x<width>]')
+        sys.exit(1)
+    folder = sys.argv[1]
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    else:
+        path = os.path.normpath(folder) + STACK_EXTENSION
+    shape = None
+    if len(sys.argv) > 3:
+        shape = tuple(int(n) for n in sys.argv[3].split('x'))
+    count = convertFolder(folder, path, shape=shape)
+    print('Wrote %d frames to %s' % (count, path))
+    sys.exit()
@@ -1,58 +1,218 @@
 '''
 @name    gauss_seidel.py
-@brief   Solve for the coefficients ai, bi, ci, di
-		 to define cubic spline
-		 This script is disabled due to special cases
-		 where there are 0's in the A matrix and the
-		 target xi will be divided by 0
+@brief   Iterative (Gauss-Seidel / SOR) solvers for the cubic spline.
+         The spline A matrix has 0's on its diagonal, so plain Gauss-Seidel
+         on getAMatrixAndBVector divides by 0, and no row order makes it
+         diagonally dominant. gsSolve reorders the rows of a general system to
+         put nonzero pivots on the diagonal before iterating, while
+         sorTridiagonal solves the strictly diagonally dominant tridiagonal
+         system in the second derivatives, for which SOR always converges.
+         Passing the previous solution as the initial guess makes refits of
+         slowly changing data take only a few sweeps
 @author  Yun-Ha Jung, 2017
 '''
 
 import sys, os, math
 import numpy as np
 
-import img_util, cubic_spline
+import cubic_spline, instrumentation
 
-def gsSolve(A, b, xi, err=0.1):
-	# Initialize variables for size of array and x vector
+DEFAULT_TOLERANCE = 1e-10
+# Change of x at which to stop whatever its size, so a solution at or near 0
+# (e.g. the second derivatives of linear data) does not iterate until underflow
+DEFAULT_ABS_TOLERANCE = 1e-12
+MAX_ITERATIONS = 10000
+# The Jacobi iteration matrix of the spline system has spectral radius at most
+# 1/2 (each diagonal is twice the sum of its row), which gives the optimal
+# SOR relaxation factor for the red-black ordering
+DEFAULT_OMEGA = 2/(1 + math.sqrt(1 - 0.5**2))
+
+
+'''
+@name       getDiagonalOrdering
+@brief      find a row order which puts the largest available entry of each
+            column on the diagonal
+@param[in]  A: square matrix
+@return     np.array: row index for each diagonal position
+'''
+def getDiagonalOrdering(A):
+    n = len(A)
+    perm = np.zeros(n, dtype=np.intp)
+    used = np.zeros(n, dtype=bool)
+    magnitude = np.abs(A)
+    for j in range(n):
+        candidates = np.where(used, -1, magnitude[:, j])
+        row = int(np.argmax(candidates))
+        if candidates[row] <= 0:
+            raise ValueError('No nonzero pivot available for column %d' % j)
+        perm[j] = row
+        used[row] = True
+    return perm
+
+
+'''
+@name       isConverged
+@brief      check whether the last sweep changed the solution by less than err
+            relative to its size, or to scale (the size of the right hand side
+            divided by the diagonal) if that is larger, or by less than atol
+'''
+def isConverged(delta_x, x, err, scale=0.0, atol=DEFAULT_ABS_TOLERANCE):
+    norm_delta_x = np.linalg.norm(delta_x)
+    if not np.isfinite(norm_delta_x):
+        raise ValueError('Iteration diverged')
+    return norm_delta_x <= err*max(np.linalg.norm(x), scale) + atol
+
+
+'''
+@name       gsSolve
+@brief      solve Ax = b with Gauss-Seidel / SOR, after reordering the rows so
+            that every diagonal entry is nonzero. Convergence is only guaranteed
+            if the reordered matrix is diagonally dominant (or symmetric positive
+            definite for 0 < omega < 2)
+@param[in]  A: matrix A in the form Ax = b
+            b: vector b in the form Ax = b
+            xi: initial guess, or None to start from 0
+            err: relative change of x at which to stop
+            omega: relaxation factor, 1 for Gauss-Seidel
+            max_iter: number of sweeps before giving up
+            atol: absolute change of x at which to stop
+@return     x: solution vector, with the shape of b
+'''
+def gsSolve(A, b, xi=None, err=DEFAULT_TOLERANCE, omega=1.0, max_iter=MAX_ITERATIONS,
+            atol=DEFAULT_ABS_TOLERANCE):
+    A = np.asarray(A, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
     n = len(b)
-    delta_x = np.zeros((n,1))
-    calc_err = err+1
+    b_shape = b.shape
+    perm = getDiagonalOrdering(A)
+    A = A[perm]
+    b = b[perm].reshape((n, -1))
 
-    # Copy the initial guess vector
-    xnew = list(xi)
+    # Scale every row by its diagonal so each update is a single dot product
+    diag = np.diag(A).copy()
+    A = A / diag[:, np.newaxis]
+    b = b / diag[:, np.newaxis]
+    A[np.arange(n), np.arange(n)] = 0
+    scale = np.linalg.norm(b)
 
-    while (calc_err > err):
-    	for i in range(n):
-    		xnew[i] = b[i]
+    if xi is None:
+        x = np.zeros(b.shape)
+    else:
+        x = np.array(xi, dtype=np.float64).reshape(b.shape)
 
-    		for j in range(n):
-    			if j == i:
-    				continue
+    for iteration in range(1, max_iter + 1):
+        x_old = x.copy()
+        for i in range(n):
+            x[i] = (1 - omega)*x[i] + omega*(b[i] - np.dot(A[i], x))
+        if isConverged(x - x_old, x, err, scale, atol):
+            instrumentation.count('gauss_seidel_iterations', iteration)
+            return x.reshape(b_shape)
+    raise ValueError('Gauss-Seidel did not converge in %d iterations' % max_iter)
 
-    			xnew[i] -= A[i][j]*xnew[j]
 
-    		xnew[i] /= A[i][i]
+'''
+@name       sorTridiagonal
+@brief      solve a tridiagonal system with SOR, updating the even and then the
+            odd unknowns in two vectorized half sweeps (red-black ordering)
+@param[in]  lower: sub-diagonal, lower[i] multiplies x[i-1] (lower[0] unused)
+            diag: main diagonal
+            upper: super-diagonal, upper[i] multiplies x[i+1] (upper[-1] unused)
+            rhs: right hand side of shape (N,) or (N,k)
+            x0: initial guess with the shape of rhs, or None to start from 0
+            omega: relaxation factor, 1 for Gauss-Seidel
+            err: relative change of x at which to stop
+            max_iter: number of sweeps before giving up
+            atol: absolute change of x at which to stop
+@return     x: solution with the shape of rhs
+@return     int: number of sweeps
+'''
+def sorTridiagonal(lower, diag, upper, rhs, x0=None, omega=DEFAULT_OMEGA,
+                   err=DEFAULT_TOLERANCE, max_iter=MAX_ITERATIONS, atol=DEFAULT_ABS_TOLERANCE):
+    rhs = np.asarray(rhs, dtype=np.float64)
+    N = len(rhs)
+    shape = (-1,) + (1,)*(rhs.ndim-1)
+    lower = np.asarray(lower, dtype=np.float64).reshape(shape)
+    diag = np.asarray(diag, dtype=np.float64).reshape(shape)
+    upper = np.asarray(upper, dtype=np.float64).reshape(shape)
+    scale = np.linalg.norm(rhs / diag)
 
-    	for k in range(n):
-    		delta_x = abs(xnew[k] - xi[k])
+    # x is padded with a 0 on each side so the neighbours of the
+    # first and last unknowns need no special case
+    padded = np.zeros((N + 2,) + rhs.shape[1:])
+    x = padded[1:N+1]
+    if x0 is not None:
+        x[...] = np.asarray(x0, dtype=np.float64).reshape(rhs.shape)
 
-    	norm_delta_x = np.linalg.norm(delta_x)
-    	norm_xold = np.linalg.norm(xi)
+    for iteration in range(1, max_iter + 1):
+        x_old = x.copy()
+        for color in (0, 1):
+            i = slice(color, N, 2)
+            update = (rhs[i] - lower[i]*padded[color:N:2] - upper[i]*padded[color+2:N+2:2]) / diag[i]
+            x[i] = (1 - omega)*x[i] + omega*update
+        if isConverged(x - x_old, x, err, scale, atol):
+            instrumentation.count('sor_iterations', iteration)
+            return x.copy(), iteration
+    raise ValueError('SOR did not converge in %d iterations' % max_iter)
 
-    	calc_err = norm_delta_x/norm_xold
-    	xi = list(xnew)
 
-    return xnew
+'''
+@name       getSecondDerivatives
+@brief      recover the second derivative at every point from spline coefficients,
+            e.g. to warm start getCoefficients from a previous fit
+@param[in]  coefficients: vector of a,b,c,d coefficients for each cubic function
+            x_vals: focus distances of the data points (ordered)
+@return     np.array: second derivative at each focus distance
+'''
+def getSecondDerivatives(coefficients, x_vals):
+    x = np.asarray(x_vals, dtype=np.float64)
+    c = np.asarray(coefficients, dtype=np.float64).reshape((len(x) - 1, 4))
+    M = np.empty(len(x))
+    M[:-1] = 6*c[:,0]*x[:-1] + 2*c[:,1]
+    M[-1] = 6*c[-1,0]*x[-1] + 2*c[-1,1]
+    return M
 
-if  __name__ == "__main__":
 
-	sample_points = [(0,0),(1,3),(2,1),(4,5)]
-	A,b = cubic_spline.getAMatrixAndBVector(sample_points)
-	xi = np.ones((len(b),1))
-	print A
-	print b
-	x = gsSolve(A,b,xi)
-	print x
-	sys.exit()
+'''
+@name       getCoefficients
+@brief      get coefficients for a natural cubic spline through points, solving
+            the tridiagonal system in the second derivatives with SOR
+@param[in]  points: List of 2-tuples representing (x,y) coordinates
+            initial: coefficients of a previous fit through the same number of
+                     points to start from, or None to start from 0
+            omega: relaxation factor
+            err: relative change of the second derivatives at which to stop
+@return     coefficients: vector of a,b,c,d coefficients for each cubic function,
+                          in the layout returned by cubic_spline.getCoefficients
+'''
+def getCoefficients(points, initial=None, omega=DEFAULT_OMEGA, err=DEFAULT_TOLERANCE):
+    x = np.array([p[0] for p in points], dtype=np.float64)
+    y = np.array([p[1] for p in points], dtype=np.float64)
+    if len(x) <= 1:
+        raise ValueError('Not enough points to fit a spline')
+    M0 = None
+    if initial is not None and len(initial) == 4*(len(x) - 1):
+        M0 = getSecondDerivatives(initial, x)
+    lower, diag, upper, rhs = cubic_spline.getTridiagonalSystem(x, y)
+    M, _ = sorTridiagonal(lower, diag, upper, rhs, M0, omega, err)
+    return cubic_spline.getCoefficientsFromSecondDerivatives(x, y, M)
+
+
+#######################
+###  Main Function  ###
+#######################
+if  __name__ == "__main__":
+    sample_points = [(0,0),(1,3),(2,1),(4,5)]
+    A,b = cubic_spline.getAMatrixAndBVector(sample_points)
+    print(A)
+    print(b)
+    coefficients = getCoefficients(sample_points)
+    print(coefficients)
 
+    # A small change to the data converges in a few sweeps from the previous fit
+    moved_points = [(0,0),(1,3.1),(2,1),(4,5)]
+    x = [p[0] for p in moved_points]
+    lower, diag, upper, rhs = cubic_spline.getTridiagonalSystem(x, [p[1] for p in moved_points])
+    _, cold = sorTridiagonal(lower, diag, upper, rhs)
+    _, warm = sorTridiagonal(lower, diag, upper, rhs, getSecondDerivatives(coefficients, x))
+    print('Sweeps from 0: %d, from the previous fit: %d' % (cold, warm))
+    sys.exit()
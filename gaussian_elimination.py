@@ -6,72 +6,123 @@
 @author  Russell Wong, Yun-Ha Jung 2017
 '''
 
-import sys, os, math, cv2
+import sys, os, math
 import numpy as np
 
-import img_util, cubic_spline
+import cubic_spline, instrumentation
 
 '''
-@name       solve
-@brief      solve system of equations [A]{x} = {b}
-@param[in]  A: coefficient matrix
-            b: the solution vector
-@return     x: the vector being solved
+@name       factorize
+@brief      perform the elimination stage of Gaussian Elimination with
+            partial pivoting, storing the multipliers below the diagonal
+            so that the factorization can be reused for any b vector
+@param[in]  A: coefficient matrix (n x n)
+            overwrite: whether A may be eliminated in place; otherwise
+                       the caller's matrix is left untouched
+@return     LU: upper triangular matrix U with the elimination factors of L
+                stored beneath the diagonal
+            perm: row order of A after pivoting
 '''
-def solve(A, b):
-    # Initialize variables for size of array and x vector
-    n = len(b)
-    x = np.zeros((n,1))
+@instrumentation.timed('elimination')
+def factorize(A, overwrite=False):
+    if overwrite and isinstance(A, np.ndarray) and A.dtype == np.float64:
+        LU = A
+    else:
+        LU = np.array(A, dtype=np.float64)
+    n = LU.shape[0]
+    perm = np.arange(n)
+    row_buf = np.empty(n)
 
-    ###########################
-    ###  Elimination stage  ###
-    ###########################
-    # Iterate through rows of A
+    # Iterate through columns of A
     for i in range(n-1):
         # Implement partial pivoting
         # Find max value in current column and swap with the top
-        pivoting_element = A[i][i]
-        pivoting_index = i
-        for row_index in range(i+1,n):
-            if abs(A[row_index][i]) > abs(pivoting_element):
-                pivoting_element = A[row_index][i]
-                pivoting_index = row_index
+        pivoting_index = i + int(np.argmax(np.abs(LU[i:,i])))
+        if LU[pivoting_index,i] == 0:
+            raise ValueError('Matrix is singular at column %d' % i)
         if pivoting_index != i:
-            # Swap rows
-            temp = list(A[i])
-            A[i] = list(A[pivoting_index])
-            A[pivoting_index] = list(temp)
-            temp = list(b[i])
-            b[i] = list(b[pivoting_index])
-            b[pivoting_index] = list(temp)
-        # Iterate through rows of A beneath current row
-        for row_index in range(i+1,n):
-            # Calculate f factor
-            f = A[row_index][i] / A[i][i]
-            # Iterate through columns of A greater than or equal to current row index and subtract
-            for col_index in range(i,n):
-                A[row_index][col_index] = A[row_index][col_index] - f*A[i][col_index]
-            # Update b vector
-            b[row_index] = b[row_index] - f*b[i]
+            # Swap rows through a preallocated buffer
+            row_buf[:] = LU[i]
+            LU[i] = LU[pivoting_index]
+            LU[pivoting_index] = row_buf
+            perm[i], perm[pivoting_index] = perm[pivoting_index], perm[i]
+
+        # Calculate f factors for all rows beneath the current row
+        # and eliminate them with a single rank-1 update
+        f = LU[i+1:,i] / LU[i,i]
+        LU[i+1:,i+1:] -= np.outer(f, LU[i,i+1:])
+        LU[i+1:,i] = f
+
+    if n > 0 and LU[n-1,n-1] == 0:
+        raise ValueError('Matrix is singular at column %d' % (n-1))
+
+    return LU, perm
+
+
+'''
+@name       substitute
+@brief      solve [A]{x} = {b} given the factorization of A from factorize
+            using forward and back substitution
+@param[in]  LU, perm: factorization of A returned by factorize
+            b: the solution vector, either of shape (n,), (n,1) or (n,k)
+               to solve for k right-hand sides at once
+            overwrite: whether the result may be written into b
+@return     x: the vector being solved, with the same shape as b
+'''
+@instrumentation.timed('back_substitution')
+def substitute(LU, perm, b, overwrite=False):
+    if overwrite and isinstance(b, np.ndarray) and b.dtype == np.float64:
+        x = b
+        x[:] = x[perm]
+    else:
+        x = np.array(b, dtype=np.float64)[perm]
+    n = LU.shape[0]
+
+    ##############################
+    ###  Forward substitution  ###
+    ##############################
+    for i in range(1, n):
+        x[i] -= np.dot(LU[i,:i], x[:i])
 
     ###########################
     ###  Back substitution  ###
     ###########################
     for i in range(n-1, -1, -1):
-        # Initialize x[i] to b[i]
-        x[i] = b[i]
-
-        # Loop through every column from the left   
-        for j in range(i,n):
-            # Subtract all elements from x[i] except for itself
-            if i != j:
-                x[i] -= A[i][j]*x[j]
-        # Divide x[i] by the coefficient in the matrix
-        x[i] /= A[i][i]
+        x[i] -= np.dot(LU[i,i+1:], x[i+1:])
+        x[i] /= LU[i,i]
 
     return x
 
 
+'''
+@name       solveVectorized
+@brief      solve system of equations [A]{x} = {b} using Gaussian Elimination
+            with partial pivoting, vectorized over rows with NumPy
+@param[in]  A: coefficient matrix
+            b: the solution vector, either of shape (n,), (n,1) or (n,k)
+               to solve for k right-hand sides with a single elimination
+            overwrite: whether A and b may be modified in place; otherwise
+                       copies are made and the caller's data is left untouched
+@return     x: the vector being solved, with the same shape as b
+'''
+def solveVectorized(A, b, overwrite=False):
+    LU, perm = factorize(A, overwrite=overwrite)
+    return substitute(LU, perm, b, overwrite=overwrite)
+
+
+'''
+@name       solve
+@brief      solve system of equations [A]{x} = {b}
+            A and b are eliminated in place
+@param[in]  A: coefficient matrix
+            b: the solution vector
+@return     x: the vector being solved
+'''
+def solve(A, b):
+    x = solveVectorized(A, b, overwrite=True)
+    return np.reshape(x, (len(x), -1))
+
+
 #######################
 ###  Main Function  ###
 #######################
@@ -82,4 +133,7 @@ if __name__ == '__main__':
     print b
     x = solve(A,b)
     print x
+    # Solve for several sharpness profiles at once with one factorization
+    B = np.hstack([b, 2*b])
+    print solveVectorized(A,B)
     sys.exit()
\ No newline at end of file
@@ -3,9 +3,11 @@
 @brief	Main file for finding the optimum of the given function
 @author	Yun-Ha Jung, Russell Wong, 2017
 '''
-import sys, os, math
+import sys, os, math, argparse, logging
 
-import sharpness_calc, cubic_spline, gaussian_elimination, img_util
+import instrumentation
+
+import sharpness_calc, focus_measures, cubic_spline, gaussian_elimination, spline_fitter, spline_function, spline_optimizer, img_util, plot_renderer
 
 REQ_ERR = 0.01
 GR = (math.sqrt(5) - 1)/2
@@ -23,32 +25,11 @@ def testFunction(x):
 			coefficients: A vector of a,b,c,d coefficients representing each cubic function in the spline
 			x_vals: A vector of distance values corresponding to the endpoints of each cubic function in the spline
 @return 	float: The calculated sharpness value
+			Raises ValueError if x is out of the bounds of x_vals
 '''
 
 def evalCubicSharpnessFunction(x,coefficients,x_vals):
-	# Initialize right, left, and middle indices
-	right_index = len(x_vals)-1
-	left_index = 0
-	middle_index = int(math.ceil((left_index+right_index)/2.0))
-
-	# Loop until the index where the x value belongs (binary search)
-	while (x > x_vals[middle_index] or x < x_vals[middle_index-1]):
-		if (middle_index == 0):
-			print "Could not find x=%f with bounds of x_vals (%f,%f)!\n" % (x, x_vals[0], x_vals[len(x_vals)-1])
-			return -1
-		if (x > x_vals[middle_index]):
-			left_index = middle_index
-		elif (x < x_vals[middle_index-1]):
-			right_index = middle_index-1
-		middle_index = int(math.ceil((left_index+right_index)/2.0))
-
-	# Extract the appropriate cubic coefficients
-	a = coefficients[4*(middle_index-1)]
-	b = coefficients[4*(middle_index-1)+1]
-	c = coefficients[4*(middle_index-1)+2]
-	d = coefficients[4*(middle_index-1)+3]
-
-	return a*x**3 + b*x**2 + c*x + d
+	return spline_function.CubicSpline(coefficients, x_vals)(x)
 
 
 def evaluateSharpnessFunction(x, coefficients, x_vals):
@@ -59,7 +40,7 @@ def evaluateSharpnessFunction(x, coefficients, x_vals):
 	middle_index = int(math.ceil((left_index+right_index)/2.0))
 	while (x > x_vals[middle_index] or x < x_vals[middle_index-1]):
 		if (middle_index == 0):
-			print "Could not find x=%f with bounds of x_vals (%f,%f)!\n" % (x, x_vals[0], x_vals[len(x_vals)-1])
+			instrumentation.report("Could not find x=%f with bounds of x_vals (%f,%f)!" % (x, x_vals[0], x_vals[len(x_vals)-1]), logging.WARNING)
 			return -1
 		if (x > x_vals[middle_index]):
 			left_index = middle_index
@@ -86,9 +67,11 @@ def evaluateSharpnessFunction(x, coefficients, x_vals):
 				    (used for sharpness calculations)
 @return 	optimum: the optimum point (x,y)
 '''
+@instrumentation.timed('golden_section')
 def goldenSection(xlow, xup, coefficients, x_vals):
 	optimum = (0,0)
-	
+	spline = spline_function.CubicSpline(coefficients, x_vals)
+
 	# Calculate distance to define x1 and x2
 	# Since golden ratio has a larger percentage than 50%,
 	# x1 is going to be closer to upper bound and 
@@ -100,12 +83,14 @@ def goldenSection(xlow, xup, coefficients, x_vals):
 	# Infinite loop to find the optimum of a function
 	# Break the loop when the calculated error is smaller than REQ_ERR
 	while(True):
+		instrumentation.count('golden_section_iterations')
 		# Calculate new distance
 		d = GR*d
 
 		# Calculate y values for given x1 and x2 values
-		y1 = evalCubicSharpnessFunction(x1,coefficients,x_vals)
-		y2 = evalCubicSharpnessFunction(x2,coefficients,x_vals)
+		with instrumentation.timer('golden_section_iteration'):
+			y1 = spline(x1)
+			y2 = spline(x2)
 
 		# Compare y1 and y2, if y1 is greater than y2 
 		# it means that the optimum falls between x2-xup range
@@ -145,33 +130,49 @@ def goldenSection(xlow, xup, coefficients, x_vals):
 #######################
 if __name__ == '__main__':
 	# Find (distance, sharpness) data points for a given set of images
-	if len(sys.argv) > 1:
-		subject_name = sys.argv[1]
-		print subject_name
-		points = sharpness_calc.getPoints(subject_name, show_images=False)
-	else:
-		points = sharpness_calc.getPoints()
-	print points
-
-	# Get A matrix and b vector required to solve for coefficients of cubicratic spline
-	A,b = cubic_spline.getAMatrixAndBVector(points)
-
-	# Solve for coefficients using Gaussian Elimination
-	coefficients = gaussian_elimination.solve(A,b)
+	# --measure selects the focus measure by name, and --output writes the
+	# plot to a file instead of showing it, as in batch_runner.py
+	parser = argparse.ArgumentParser(description='Find the optimal focus distance of a subject')
+	parser.add_argument('subject_name', nargs='?', default='111')
+	parser.add_argument('--measure', default=focus_measures.DEFAULT_MEASURE,
+						choices=sorted(focus_measures.FOCUS_MEASURES))
+	parser.add_argument('--output', default=None, help='File to render the plot to')
+	parser.add_argument('--cache', default=None,
+						help='SQLite sharpness cache file, so repeated runs skip decoding')
+	parser.add_argument('--coarse-to-fine', action='store_true',
+						help='Score every image downscaled and only rescore the images around the coarse peak')
+	args = parser.parse_args()
+	subject_name = args.subject_name
+	instrumentation.report('Subject ' + subject_name)
+
+	cache = None
+	if args.cache is not None:
+		import sharpness_cache
+		cache = sharpness_cache.SharpnessCache(args.cache)
+	try:
+		if args.coarse_to_fine:
+			folder = sharpness_calc.DEFAULT_IMG_DIR + subject_name
+			points = sharpness_calc.getPointsCoarseToFine(folder, measure=args.measure, cache=cache)
+		else:
+			points = sharpness_calc.getPoints(subject_name, measure=args.measure, cache=cache)
+	finally:
+		if cache is not None:
+			cache.close()
+	instrumentation.report('Points: %s' % (points,), logging.DEBUG)
+
+	# Solve for coefficients of the natural cubic spline using the
+	# tridiagonal system in the second derivatives (Thomas Algorithm)
+	# The factorization is reused for every set of points with the same focus distances
 	x_vals = [p[0] for p in points]
+	coefficients = spline_fitter.getFitter(x_vals).fit([p[1] for p in points])
 
-	# Find the optimum sharpness and focus distance using Golden-Section 
-	opt1 = goldenSection(x_vals[0],(x_vals[0]+x_vals[len(x_vals)-1])/2,coefficients,x_vals)
-	opt2 = goldenSection((x_vals[0]+x_vals[len(x_vals)-1])/2,x_vals[len(x_vals)-1],coefficients,x_vals)
-	opt3 = goldenSection(x_vals[0], x_vals[len(x_vals)-1],coefficients,x_vals)
+	# Find the optimum sharpness and focus distance exactly from the critical
+	# points of each cubic function in the spline
+	opt = spline_optimizer.findMaximum(coefficients, x_vals)
 
-	max_sharpness = max(opt1[1], opt2[1], opt3[1])
-	if max_sharpness == opt1[1]:
-		opt = opt1
-	elif max_sharpness == opt2[1]:
-		opt = opt2
+	instrumentation.report('X: %f, Y: %f' % (opt[0], opt[1]))
+	title = 'Cubic Spline for Subject #' + subject_name
+	if args.output is not None:
+		plot_renderer.renderCubic(args.output, coefficients, x_vals, title, opt[0], opt[1], points)
 	else:
-		opt = opt3
-
-	print 'X: %f, Y: %f' % (opt[0], opt[1])
-	img_util.plotCubic(coefficients, x_vals, 'Cubic Spline for Subject #' + subject_name, opt[0], opt[1])
+		img_util.plotCubic(coefficients, x_vals, title, opt[0], opt[1])
@@ -4,9 +4,20 @@
 @author  Russell Wong, 2017
 '''
 
-import cv2
 import numpy as np
-from matplotlib import pyplot as plt
+
+import spline_function, instrumentation, lazy_import
+
+# OpenCV and pyplot are only imported once an image is read or a plot is shown
+cv2 = lazy_import.LazyModule('cv2')
+plt = lazy_import.LazyModule('matplotlib.pyplot')
+
+# Names of the decoder flags which read an image in grayscale at a reduced size
+REDUCED_GRAYSCALE_FLAGS = {
+    2: 'IMREAD_REDUCED_GRAYSCALE_2',
+    4: 'IMREAD_REDUCED_GRAYSCALE_4',
+    8: 'IMREAD_REDUCED_GRAYSCALE_8',
+}
 
 '''
 @name       usingCV2
@@ -36,9 +47,23 @@ def checkCVVersion(version):
     return cv2.__version__.startswith(version)
 
 
+'''
+@name       maximizeWindow
+@brief      Maximizes the current matplotlib window. Only Tk windows report their
+            maximum size, other backends (including headless ones) are left as is
+'''
+def maximizeWindow():
+    fig_manager = plt.get_current_fig_manager()
+    window = getattr(fig_manager, 'window', None)
+    if hasattr(window, 'maxsize'):
+        fig_manager.resize(*window.maxsize())
+
+
 '''
 @name       plot
-@brief      Uses matplotlib to plot and show image
+@brief      Uses matplotlib to plot and show image. The window opens with the
+            configured matplotlib backend (e.g. MPLBACKEND=TkAgg); to write the image
+            to a file instead, use plot_renderer.renderImage
 @param[in]  img: The image to be plotted
 @param[in]  title: The title of the image
 @param[in]  cmap: Matplotlib colour options (e.g. cmap='gray')
@@ -46,10 +71,8 @@ def checkCVVersion(version):
 @param[in]  maximize: Whether to maximize the window
 '''
 def plot(img, title, cmap=None, maximize=True):
-    plt.switch_backend('TkAgg')
     if (maximize):
-        fig_manager = plt.get_current_fig_manager()
-        fig_manager.resize(*fig_manager.window.maxsize())
+        maximizeWindow()
     plt.imshow(img, cmap=cmap)
     plt.title(title)
     plt.xticks([]), plt.yticks([])
@@ -59,30 +82,24 @@ def plot(img, title, cmap=None, maximize=True):
 def plotPoints(points, title, maximize=True):
     x = [p[0] for p in points]
     y = [p[1] for p in points]
-    plt.switch_backend('TkAgg')
     if (maximize):
-        fig_manager = plt.get_current_fig_manager()
-        fig_manager.resize(*fig_manager.window.maxsize())
+        maximizeWindow()
     plt.title(title)
     plt.scatter(x, y)
     plt.show()
 
 
 def plotParabolas(coefficients, x_vals, title, max_x, max_y, maximize=True):
-    x = []
-    y = []
-    y_vals = []
-    for i in range(len(x_vals)-1):
-        y_vals.append(coefficients[3*i]*x_vals[i]**2 + coefficients[3*i+1]*x_vals[i] + coefficients[3*i+2])
-        for x_val in range(x_vals[i],x_vals[i+1]):
-            x.append(x_val)
-            y_val = coefficients[3*i]*x_val**2 + coefficients[3*i+1]*x_val + coefficients[3*i+2]
-            y.append(y_val)
-    y_vals.append(coefficients[3*i]*x_vals[len(x_vals)-1]**2 + coefficients[3*i+1]*x_vals[len(x_vals)-1] + coefficients[3*i+2])
-    plt.switch_backend('TkAgg')
+    # Evaluate each quadratic at every integer distance of its interval in one pass
+    knots = np.asarray(x_vals, dtype=np.float64).ravel()
+    c = np.asarray(coefficients, dtype=np.float64).reshape((len(knots)-1, 3))
+    x = np.arange(knots[0], knots[-1])
+    i = np.clip(np.searchsorted(knots, x, side='right') - 1, 0, len(c) - 1)
+    y = (c[i,0]*x + c[i,1])*x + c[i,2]
+    i = np.minimum(np.arange(len(knots)), len(c) - 1)
+    y_vals = (c[i,0]*knots + c[i,1])*knots + c[i,2]
     if (maximize):
-        fig_manager = plt.get_current_fig_manager()
-        fig_manager.resize(*fig_manager.window.maxsize())
+        maximizeWindow()
     plt.title(title)
     plt.scatter(x,y)
     plt.plot(x_vals, y_vals, color='r')
@@ -91,7 +108,8 @@ def plotParabolas(coefficients, x_vals, title, max_x, max_y, maximize=True):
 
 '''
 @name       plotCubic
-@brief      Plot cubic splines
+@brief      Plot cubic splines in a window (see plot_renderer.renderCubic
+            to write the plot to a file instead)
 @param[in]  coefficients: vector of coefficients of cubic equations
             x_vals: focus distance values from data points
             title: title of the plot
@@ -100,20 +118,13 @@ def plotParabolas(coefficients, x_vals, title, max_x, max_y, maximize=True):
             maximize: whether the plot window is maximized
 '''
 def plotCubic(coefficients, x_vals, title, max_x, max_y, maximize=True):
-    x = []
-    y = []
-    y_vals = []
-    for i in range(len(x_vals)-1):
-        y_vals.append(coefficients[4*i]*x_vals[i]**3 + coefficients[4*i+1]*x_vals[i]**2 + coefficients[4*i+2]*x_vals[i] + coefficients[4*i+3])
-        for x_val in range(x_vals[i],x_vals[i+1]):
-            x.append(x_val)
-            y_val = coefficients[4*i]*x_val**3 + coefficients[4*i+1]*x_val**2 + coefficients[4*i+2]*x_val + coefficients[4*i+3]
-            y.append(y_val)
-    y_vals.append(coefficients[4*i]*x_vals[len(x_vals)-1]**3 + coefficients[4*i+1]*x_vals[len(x_vals)-1]**2 + coefficients[4*i+2]*x_vals[len(x_vals)-1] + coefficients[4*i+3])
-    plt.switch_backend('TkAgg')
+    # Evaluate the spline at every integer distance in one vectorized pass
+    spline = spline_function.CubicSpline(coefficients, x_vals)
+    x = np.arange(x_vals[0], x_vals[len(x_vals)-1])
+    y = spline(x)
+    y_vals = spline(x_vals)
     if (maximize):
-        fig_manager = plt.get_current_fig_manager()
-        fig_manager.resize(*fig_manager.window.maxsize())
+        maximizeWindow()
     plt.title(title, fontsize=36)
     plt.xlabel('Focus Distance [mm]', fontsize=24)
     plt.ylabel('Relative Sharpness Value', fontsize=24)
@@ -157,7 +168,60 @@ def readImageRGB(name):
 @name       readImageBW
 @brief      Reads an image to a black and white cv2 matrix
 @param[in]  name: String representing relative file path and name for the image
+@param[in]  downscale: Integer factor to shrink the image by. Factors of 2, 4 and 8
+                       are applied by the decoder, so JPEGs are never decoded
+                       at full resolution
 @return     np.array: BW image
 '''
-def readImageBW(name):
-    return cv2.imread(name, cv2.IMREAD_GRAYSCALE)
\ No newline at end of file
+@instrumentation.timed('decode')
+def readImageBW(name, downscale=1):
+    if downscale == 1:
+        return cv2.imread(name, cv2.IMREAD_GRAYSCALE)
+
+    # Let the decoder do as much of the reduction as possible
+    reduction = 1
+    for factor in sorted(REDUCED_GRAYSCALE_FLAGS, reverse=True):
+        if downscale % factor == 0:
+            reduction = factor
+            break
+    if reduction == 1:
+        img = cv2.imread(name, cv2.IMREAD_GRAYSCALE)
+    else:
+        img = cv2.imread(name, getattr(cv2, REDUCED_GRAYSCALE_FLAGS[reduction]))
+    if img is None or reduction == downscale:
+        return img
+    return downscaleImage(img, downscale // reduction)
+
+
+'''
+@name       downscaleImage
+@brief      Shrinks an image by an integer factor, averaging each block of pixels
+@param[in]  img: The image to be shrunk
+@param[in]  downscale: Integer factor to shrink the image by
+@return     np.array: The shrunk image
+'''
+def downscaleImage(img, downscale):
+    if downscale == 1:
+        return img
+    height, width = img.shape[:2]
+    size = (max(1, width // downscale), max(1, height // downscale))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+'''
+@name       resizeImage
+@brief      Resizes an image to a given shape, averaging pixels when shrinking
+            and interpolating when enlarging
+@param[in]  img: The image to be resized
+@param[in]  shape: (height, width) of the result
+@return     np.array: The resized image
+'''
+def resizeImage(img, shape):
+    height, width = shape
+    if img.shape[:2] == (height, width):
+        return img
+    if height <= img.shape[0] and width <= img.shape[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    return cv2.resize(img, (width, height), interpolation=interpolation)
\ No newline at end of file
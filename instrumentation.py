@@ -0,0 +1,359 @@
+'''
+@name    instrumentation.py
+@brief   Lightweight named timers and counters for the hot paths of the pipeline
+         (decode, sharpness, matrix assembly, elimination, substitution and
+         golden-section iterations), exported as JSON or as a Chrome trace
+         (chrome://tracing). When disabled, timers and counters are no-ops.
+         Also routes the pipeline's progress messages either to stdout, as before,
+         or to leveled logging.
+
+         Profiling can be switched on without editing code through environment
+         variables: AUTOFOCUS_PROFILE=<file> enables instrumentation and writes the
+         results on exit (a Chrome trace if the name ends in .trace.json), and
+         AUTOFOCUS_LOG=<level> sends messages to logging at that level.
+         Worker processes record into their own copy of this module; process pools
+         started with initWorker and running WorkerJob send their records back to be
+         merged with mergeResults, so they appear in getStats and the trace
+@author  Russell Wong, 2017
+'''
+
+import sys, os, time, json, atexit, logging, threading, functools
+
+logger = logging.getLogger('autofocus')
+
+_enabled = False
+_tracing = False
+_use_logging = False
+_lock = threading.Lock()
+# name -> [count, total seconds, min seconds, max seconds]
+_timers = {}
+# name -> count
+_counters = {}
+# Completed timer spans (name, start, duration, process id, thread id) when tracing
+_events = []
+_start_time = time.time()
+
+'''
+@name       NullTimer
+@brief      Timer used while instrumentation is disabled, which does nothing
+'''
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+
+
+'''
+@name       Timer
+@brief      Context manager which adds the time spent inside it to a named timer
+'''
+class Timer(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        duration = end - self.start
+        with _lock:
+            stats = _timers.get(self.name)
+            if stats is None:
+                _timers[self.name] = [1, duration, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = min(stats[2], duration)
+                stats[3] = max(stats[3], duration)
+            if _tracing:
+                _events.append((self.name, self.start, duration, os.getpid(),
+                                threading.current_thread().ident))
+        return False
+
+
+'''
+@name       enable
+@brief      Start recording timers and counters
+@param[in]  trace: Whether to also keep every timer span for exportChromeTrace
+'''
+def enable(trace=False):
+    global _enabled, _tracing
+    _enabled = True
+    _tracing = trace
+
+
+'''
+@name       disable
+@brief      Stop recording timers and counters, keeping what was recorded
+'''
+def disable():
+    global _enabled, _tracing
+    _enabled = False
+    _tracing = False
+
+
+'''
+@name       isEnabled
+@brief      Check whether timers and counters are being recorded
+'''
+def isEnabled():
+    return _enabled
+
+
+'''
+@name       reset
+@brief      Discard every recorded timer, counter and trace event
+'''
+def reset():
+    global _start_time
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        del _events[:]
+        _start_time = time.time()
+
+
+'''
+@name       timer
+@brief      Time a block of code under a name
+            e.g. with instrumentation.timer('decode'): img = cv2.imread(...)
+@param[in]  name: Name of the timer
+@return     context manager
+'''
+def timer(name):
+    if not _enabled:
+        return NULL_TIMER
+    return Timer(name)
+
+
+'''
+@name       timed
+@brief      Decorator which times every call of a function under a name
+@param[in]  name: Name of the timer
+'''
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with Timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+'''
+@name       count
+@brief      Add to a named counter
+@param[in]  name: Name of the counter
+@param[in]  n: Amount to add
+'''
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+'''
+@name       takeRecords
+@brief      Remove and return everything recorded so far, e.g. in a worker process
+            to send it to the parent for mergeRecords
+@return     (timers, counters, events), or None if instrumentation is disabled
+'''
+def takeRecords():
+    if not _enabled:
+        return None
+    with _lock:
+        records = (dict((name, list(stats)) for name, stats in _timers.items()),
+                   dict(_counters), list(_events))
+        _timers.clear()
+        _counters.clear()
+        del _events[:]
+    return records
+
+
+'''
+@name       mergeRecords
+@brief      Add records taken in another process to those of this one
+@param[in]  records: Result of takeRecords, or None
+'''
+def mergeRecords(records):
+    if records is None or not _enabled:
+        return
+    timers, counters, events = records
+    with _lock:
+        for name, (n, total, low, high) in timers.items():
+            stats = _timers.get(name)
+            if stats is None:
+                _timers[name] = [n, total, low, high]
+            else:
+                stats[0] += n
+                stats[1] += total
+                stats[2] = min(stats[2], low)
+                stats[3] = max(stats[3], high)
+        for name, value in counters.items():
+            _counters[name] = _counters.get(name, 0) + value
+        if _tracing:
+            _events.extend(events)
+
+
+'''
+@name       initWorker
+@brief      Process pool initializer which copies the instrumentation state of the
+            parent into a worker, discarding records inherited when forking
+            e.g. multiprocessing.Pool(workers, instrumentation.initWorker,
+                                      instrumentation.getWorkerState())
+@param[in]  enabled, trace: As returned by getWorkerState
+'''
+def initWorker(enabled, trace):
+    global _enabled, _tracing
+    reset()
+    _enabled = enabled
+    _tracing = trace
+
+
+'''
+@name       getWorkerState
+@brief      Arguments of initWorker for the current instrumentation state
+'''
+def getWorkerState():
+    return (_enabled, _tracing)
+
+
+'''
+@name       WorkerJob
+@brief      Wraps a function run on a process pool so that every call also returns
+            what the worker recorded during it, for mergeResults
+@param[in]  function: Module level function taking a single job
+'''
+class WorkerJob(object):
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, job):
+        result = self.function(job)
+        return result, takeRecords()
+
+
+'''
+@name       mergeResults
+@brief      Merge the records returned by WorkerJob as its results arrive
+@param[in]  results: Iterable of (result, records) from a pool running a WorkerJob
+@return     generator of the results
+'''
+def mergeResults(results):
+    for result, records in results:
+        mergeRecords(records)
+        yield result
+
+
+'''
+@name       getStats
+@brief      Summarize everything recorded so far
+@return     dict: 'timers' maps each name to its count, total, mean, min and max
+            seconds, and 'counters' maps each name to its count
+'''
+def getStats():
+    with _lock:
+        timers = {}
+        for name, (n, total, low, high) in _timers.items():
+            timers[name] = {'count': n, 'total': total, 'mean': total / n, 'min': low, 'max': high}
+        return {'timers': timers, 'counters': dict(_counters)}
+
+
+'''
+@name       exportJSON
+@brief      Write getStats to a JSON file
+@param[in]  path: String representing path of the output file
+'''
+def exportJSON(path):
+    with open(path, 'w') as f:
+        json.dump(getStats(), f, indent=2, sort_keys=True)
+
+
+'''
+@name       exportChromeTrace
+@brief      Write every recorded timer span (see enable) and the final counter values
+            in the Chrome trace event format
+@param[in]  path: String representing path of the output file
+'''
+def exportChromeTrace(path):
+    pid = os.getpid()
+    with _lock:
+        events = [{'name': name, 'ph': 'X', 'pid': event_pid, 'tid': tid,
+                   'ts': (start - _start_time)*1e6, 'dur': duration*1e6}
+                  for name, start, duration, event_pid, tid in _events]
+        end = (time.time() - _start_time)*1e6
+        for name, value in _counters.items():
+            events.append({'name': name, 'ph': 'C', 'pid': pid, 'ts': end, 'args': {name: value}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events}, f)
+
+
+'''
+@name       useLogging
+@brief      Send report messages to the 'autofocus' logger instead of stdout
+@param[in]  enabled: Whether to use logging
+@param[in]  level: Level of the 'autofocus' logger, which is given a handler if
+                   logging is not configured yet
+'''
+def useLogging(enabled=True, level=logging.INFO):
+    global _use_logging
+    _use_logging = enabled
+    if enabled:
+        logger.setLevel(level)
+        if not logging.getLogger().handlers and not logger.handlers:
+            logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+
+'''
+@name       report
+@brief      Print a progress message, or log it if useLogging is on. Without logging,
+            messages below INFO (e.g. per-image details) are dropped
+@param[in]  message: The message
+@param[in]  level: Logging level of the message
+'''
+def report(message, level=logging.INFO):
+    if _use_logging:
+        logger.log(level, message)
+    elif level >= logging.INFO:
+        print(message)
+
+
+'''
+@name       _exportOnExit
+@brief      Write the recorded results to the AUTOFOCUS_PROFILE file on exit
+'''
+def _exportOnExit(path):
+    if path.endswith('.trace.json'):
+        exportChromeTrace(path)
+    else:
+        exportJSON(path)
+
+
+if os.environ.get('AUTOFOCUS_PROFILE'):
+    enable(trace=os.environ['AUTOFOCUS_PROFILE'].endswith('.trace.json'))
+    atexit.register(_exportOnExit, os.environ['AUTOFOCUS_PROFILE'])
+if os.environ.get('AUTOFOCUS_LOG'):
+    useLogging(level=getattr(logging, os.environ['AUTOFOCUS_LOG'].upper(), logging.INFO))
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    enable(trace=True)
+    for i in range(3):
+        with timer('sleep'):
+            time.sleep(0.01)
+        count('iterations')
+    print(json.dumps(getStats(), indent=2, sort_keys=True))
+    sys.exit()
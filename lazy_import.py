@@ -0,0 +1,57 @@
+'''
+@name    lazy_import.py
+@brief   Defers importing heavy modules (OpenCV, matplotlib) until one of their
+         attributes is first used, so that importing a module which only needs
+         them for some functions stays fast. e.g.
+             cv2 = lazy_import.LazyModule('cv2')
+             img = cv2.imread(name)   # cv2 is imported here
+@author  Russell Wong, 2017
+'''
+
+import sys, importlib, threading
+
+'''
+@name       LazyModule
+@brief      Stand-in for a module which imports it on first attribute access
+@param[in]  name: Full name of the module, e.g. 'matplotlib.pyplot'
+'''
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    '''
+    @name       loadModule
+    @brief      import the module if it is not imported yet
+    @return     module: the real module
+    '''
+    def loadModule(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    module = importlib.import_module(self.__dict__['_name'])
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self.loadModule(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.loadModule(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self.__dict__['_name']
+
+
+'''
+@name       isLoaded
+@brief      Check whether a module has actually been imported, e.g. to verify that
+            importing something did not pull in OpenCV
+@param[in]  name: Full name of the module
+@return     bool: True if the module is in sys.modules
+'''
+def isLoaded(name):
+    return name in sys.modules
@@ -0,0 +1,195 @@
+'''
+@name    plot_renderer.py
+@brief   Off-screen equivalents of the img_util plot functions. Figures are drawn
+         with the Agg canvas directly instead of through pyplot, so they never open
+         a window, never change the pyplot backend and are safe to render from
+         several processes at once. Curves are sampled with vectorized spline
+         evaluation, and the output format (PNG, SVG, PDF, ...) is taken from the
+         extension of the file name
+@author  Russell Wong, 2017
+'''
+
+import sys, multiprocessing
+import numpy as np
+
+import spline_function
+
+DEFAULT_FIGSIZE = (12, 8)
+DEFAULT_DPI = 100
+# Points each curve is sampled at
+NUM_SAMPLES = 1000
+
+'''
+@name       newFigure
+@brief      Creates a figure attached to an Agg canvas, with a single set of axes
+@param[in]  title: The title of the plot
+@return     fig: The figure
+@return     ax: Its axes
+'''
+def newFigure(title, figsize=DEFAULT_FIGSIZE):
+    # matplotlib is only imported once the first plot is rendered
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.set_title(title, fontsize=18)
+    return fig, ax
+
+
+'''
+@name       labelSharpnessAxes
+@brief      Labels axes as sharpness against focus distance
+'''
+def labelSharpnessAxes(ax):
+    ax.set_xlabel('Focus Distance [mm]', fontsize=14)
+    ax.set_ylabel('Relative Sharpness Value', fontsize=14)
+
+
+'''
+@name       renderImage
+@brief      Renders an image to a file, as img_util.plot
+@param[in]  name: String representing path of the output file
+            img: The image to be rendered
+            title: The title of the image
+            cmap: Matplotlib colour options (e.g. cmap='gray'),
+                  renders a colour image when cmap=None
+'''
+def renderImage(name, img, title, cmap=None, dpi=DEFAULT_DPI):
+    fig, ax = newFigure(title)
+    ax.imshow(img, cmap=cmap)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    fig.savefig(name, dpi=dpi)
+
+
+'''
+@name       renderPoints
+@brief      Renders (x,y) data points to a file, as img_util.plotPoints
+@param[in]  name: String representing path of the output file
+            points: List of 2-tuples representing (x,y) coordinates
+            title: The title of the plot
+'''
+def renderPoints(name, points, title, dpi=DEFAULT_DPI):
+    fig, ax = newFigure(title)
+    labelSharpnessAxes(ax)
+    ax.scatter([p[0] for p in points], [p[1] for p in points])
+    fig.savefig(name, dpi=dpi)
+
+
+'''
+@name       sampleParabolas
+@brief      Evaluates a quadratic spline on evenly spaced focus distances
+@param[in]  coefficients: vector of a,b,c coefficients of each quadratic equation
+            x_vals: focus distance values from data points
+@return     x, y: np.arrays of the sampled curve
+'''
+def sampleParabolas(coefficients, x_vals, num_samples=NUM_SAMPLES):
+    x_vals = np.asarray(x_vals, dtype=np.float64).ravel()
+    c = np.asarray(coefficients, dtype=np.float64).reshape((len(x_vals) - 1, 3))
+    x = np.linspace(x_vals[0], x_vals[-1], num_samples)
+    i = np.clip(np.searchsorted(x_vals, x, side='left') - 1, 0, len(c) - 1)
+    return x, (c[i,0]*x + c[i,1])*x + c[i,2]
+
+
+'''
+@name       renderParabolas
+@brief      Renders a quadratic spline and its maximum to a file, as img_util.plotParabolas
+@param[in]  name: String representing path of the output file
+            coefficients: vector of coefficients of quadratic equations
+            x_vals: focus distance values from data points
+            title: title of the plot
+            max_x: x value of the maximum of the spline
+            max_y: y value of the maximum of the spline
+'''
+def renderParabolas(name, coefficients, x_vals, title, max_x, max_y, dpi=DEFAULT_DPI):
+    x, y = sampleParabolas(coefficients, x_vals)
+    fig, ax = newFigure(title)
+    labelSharpnessAxes(ax)
+    ax.plot(x, y, color='r')
+    ax.plot(max_x, max_y, 'bo')
+    fig.savefig(name, dpi=dpi)
+
+
+'''
+@name       renderCubic
+@brief      Renders a cubic spline and its maximum to a file, as img_util.plotCubic
+@param[in]  name: String representing path of the output file
+            coefficients: vector of coefficients of cubic equations
+            x_vals: focus distance values from data points
+            title: title of the plot
+            max_x: x value of the maximum of the cubic spline
+            max_y: y value of the maximum of the cubic spline
+            points: optional (x,y) data points to draw over the spline
+'''
+def renderCubic(name, coefficients, x_vals, title, max_x, max_y, points=None, dpi=DEFAULT_DPI):
+    spline = spline_function.CubicSpline(coefficients, x_vals)
+    x = np.linspace(spline.x_min, spline.x_max, NUM_SAMPLES)
+    fig, ax = newFigure(title)
+    labelSharpnessAxes(ax)
+    ax.plot(x, spline(x), color='r')
+    if points is not None:
+        ax.scatter([p[0] for p in points], [p[1] for p in points])
+    ax.plot(max_x, max_y, 'bo')
+    fig.savefig(name, dpi=dpi)
+
+
+# Renderers by name, for renderMany
+RENDERERS = {
+    'image': renderImage,
+    'points': renderPoints,
+    'parabolas': renderParabolas,
+    'cubic': renderCubic,
+}
+
+
+'''
+@name       renderJob
+@brief      Renders a single plot. Defined at module level so that it can be used
+            with a process pool
+@param[in]  job: 2-tuple (renderer name, tuple of arguments) or 3-tuple which
+                 also has a dict of keyword arguments
+@return     string: The output file name
+'''
+def renderJob(job):
+    kind, args = job[0], job[1]
+    kwargs = job[2] if len(job) > 2 else {}
+    RENDERERS[kind](*args, **kwargs)
+    return args[0]
+
+
+'''
+@name       renderMany
+@brief      Renders many plots concurrently on a pool of worker processes
+@param[in]  jobs: List of jobs as in renderJob, e.g.
+                  ('cubic', (name, coefficients, x_vals, title, max_x, max_y))
+@param[in]  workers: Number of plots rendered concurrently
+@return     names: List of the output file names, in the order of jobs
+'''
+def renderMany(jobs, workers=multiprocessing.cpu_count()):
+    for job in jobs:
+        if job[0] not in RENDERERS:
+            raise ValueError('Unknown renderer %r, expected one of %s'
+                             % (job[0], ', '.join(sorted(RENDERERS))))
+    if not jobs:
+        return []
+    pool = multiprocessing.Pool(max(1, min(workers, len(jobs))))
+    try:
+        names = pool.map(renderJob, jobs)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return names
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    # y = x^3 on [0,1] and y = 3x^2 - 3x + 1 on [1,2]
+    coefficients = [1,0,0,0,0,3,-3,1]
+    jobs = [('cubic', ('cubic.%s' % ext, coefficients, [0,1,2], 'Cubic Spline', 2, 7))
+            for ext in ('png', 'svg')]
+    print(renderMany(jobs))
+    sys.exit()
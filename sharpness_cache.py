@@ -0,0 +1,181 @@
+'''
+@name    sharpness_cache.py
+@brief   Persistent on-disk cache of sharpness values so that repeated runs over
+         the same images skip decoding and convolution. Entries are keyed by the
+         image path, size and modification time (and optionally a hash of its
+         contents) together with the focus measure and its parameters, stored in
+         SQLite and evicted least recently used first. Cache hits only note when
+         each entry was used in memory, and insertions are committed in batches,
+         so neither a hit nor a miss waits for a disk sync. Everything is written
+         by flush or close, and at least every COMMIT_EVERY insertions
+@author  Russell Wong, 2017
+'''
+
+import sys, os, time, json, hashlib, sqlite3, threading
+
+DEFAULT_CACHE_PATH = '.sharpness_cache.db'
+DEFAULT_MAX_ENTRIES = 100000
+# Fraction of max_entries kept when the cache is full, so that eviction
+# does not run on every insertion
+EVICT_TO = 0.9
+# Insertions written to the database before each commit
+COMMIT_EVERY = 100
+
+'''
+@name       SharpnessCache
+@brief      SQLite-backed cache of sharpness values, safe to share between threads
+@param[in]  path: String representing path to the database file
+            max_entries: number of entries kept before the least recently used are evicted
+            hash_contents: whether to key entries by a SHA-1 of the file contents as
+                           well, which survives copies that reset the modification time
+                           but costs a full read of the file
+'''
+class SharpnessCache(object):
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 hash_contents=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.hash_contents = hash_contents
+        self.lock = threading.Lock()
+        # Key -> time of the last cache hit, not yet written to the database
+        self.touched = {}
+        # Insertions since the last commit
+        self.uncommitted = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS sharpness ('
+                                    'key TEXT PRIMARY KEY, value REAL, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS sharpness_last_used '
+                                    'ON sharpness (last_used)')
+            self.connection.commit()
+            # Number of entries, kept up to date so insertions need no full count
+            self.count = self.connection.execute('SELECT COUNT(*) FROM sharpness').fetchone()[0]
+
+    '''
+    @name       makeKey
+    @brief      build the cache key of an image and focus measure
+    @param[in]  image_path: String representing path to the image
+                measure: Name of the focus measure
+                params: JSON-serializable parameters of the measure (e.g. roi, downscale)
+    @return     string: the cache key
+    '''
+    def makeKey(self, image_path, measure, params=None):
+        stat = os.stat(image_path)
+        key = {
+            'path': os.path.abspath(image_path),
+            'size': stat.st_size,
+            'mtime': getattr(stat, 'st_mtime_ns', stat.st_mtime),
+            'measure': measure,
+            'params': params,
+        }
+        if self.hash_contents:
+            sha1 = hashlib.sha1()
+            with open(image_path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+            key['sha1'] = sha1.hexdigest()
+        return json.dumps(key, sort_keys=True)
+
+    '''
+    @name       get
+    @brief      look up the sharpness of an image
+    @return     float: the cached sharpness value, or None if it is not cached
+    '''
+    def get(self, image_path, measure, params=None):
+        key = self.makeKey(image_path, measure, params)
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM sharpness WHERE key = ?',
+                                          (key,)).fetchone()
+            if row is None:
+                return None
+            self.touched[key] = time.time()
+        return row[0]
+
+    '''
+    @name       writeTouched
+    @brief      write the last used times of cache hits to the database, without
+                committing. Must be called with the lock held
+    '''
+    def writeTouched(self):
+        if self.touched:
+            self.connection.executemany('UPDATE sharpness SET last_used = ? WHERE key = ?',
+                                        [(t, key) for key, t in self.touched.items()])
+            self.touched = {}
+
+    '''
+    @name       put
+    @brief      store the sharpness of an image, evicting old entries if the cache is full
+    '''
+    def put(self, image_path, measure, params, value):
+        key = self.makeKey(image_path, measure, params)
+        with self.lock:
+            # Hits are written first so eviction sees which entries are in use
+            self.writeTouched()
+            exists = self.connection.execute('SELECT 1 FROM sharpness WHERE key = ?',
+                                             (key,)).fetchone() is not None
+            self.connection.execute('INSERT OR REPLACE INTO sharpness VALUES (?, ?, ?)',
+                                    (key, float(value), time.time()))
+            if not exists:
+                self.count += 1
+            if self.count > self.max_entries:
+                cursor = self.connection.execute(
+                    'DELETE FROM sharpness WHERE key IN (SELECT key FROM sharpness '
+                    'ORDER BY last_used LIMIT ?)', (self.count - int(self.max_entries*EVICT_TO),))
+                self.count -= cursor.rowcount
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self.commit()
+
+    '''
+    @name       commit
+    @brief      commit the outstanding insertions. Must be called with the lock held
+    '''
+    def commit(self):
+        self.connection.commit()
+        self.uncommitted = 0
+
+    '''
+    @name       flush
+    @brief      write the insertions and the last used times of cache hits to disk
+    '''
+    def flush(self):
+        with self.lock:
+            self.writeTouched()
+            self.commit()
+
+    '''
+    @name       clear
+    @brief      remove every entry from the cache
+    '''
+    def clear(self):
+        with self.lock:
+            self.touched = {}
+            self.connection.execute('DELETE FROM sharpness')
+            self.commit()
+            self.count = 0
+
+    '''
+    @name       close
+    @brief      write outstanding last used times and close the database connection
+    '''
+    def close(self):
+        with self.lock:
+            self.writeTouched()
+            self.commit()
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.count
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    cache = SharpnessCache()
+    print('%d cached sharpness values in %s' % (len(cache), cache.path))
+    if len(sys.argv) > 1 and sys.argv[1] == 'clear':
+        cache.clear()
+    cache.close()
+    sys.exit()
@@ -4,34 +4,75 @@
 @author  Russell Wong, 2017
 '''
 
-import sys, os, math, cv2
+import sys, os, math, numbers, logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
-from matplotlib import pyplot as plt
+try:
+    import resource
+except ImportError:
+    resource = None
 
-import img_util
+import img_util, focus_measures, folder_index, frame_stack, instrumentation, lazy_import
+
+cv2 = lazy_import.LazyModule('cv2')
 
 DEFAULT_IMG_DIR = 'RTImg/'
+DEFAULT_MEASURE = focus_measures.DEFAULT_MEASURE
+DEFAULT_WORKERS = multiprocessing.cpu_count()
+SOBEL_KSIZE = 5
+# Pixels around a region that the Sobel kernel reads
+SOBEL_BORDER = SOBEL_KSIZE // 2
+# Pyramid level every frame is scored at by getPointsCoarseToFine
+COARSE_DOWNSCALE = 8
+# Frames on each side of the coarse peak rescored at full resolution
+BRACKET_MARGIN = 2
+# Derivative depths for the low memory path. The 5x5 Sobel of a uint8 image
+# cannot exceed 48*255 in magnitude, so both hold it exactly
+LOW_MEMORY_DEPTHS = {'int16': 'CV_16S', 'float32': 'CV_32F'}
+LOW_MEMORY_DTYPES = {'int16': np.int16, 'float32': np.float32}
+DEFAULT_LOW_MEMORY_DEPTH = 'int16'
 
 
 '''
 @name       loadImages
-@brief      Retrieves all images from a folder and loads them into black-and-white matrices
-@param[in]  folder: String representing path to folder containing images
+@brief      Retrieves all images from a folder and loads them into black-and-white matrices,
+            in order of focus distance
+@param[in]  folder: String representing path to folder containing images, or to a
+                    frame_stack file
+@param[in]  downscale: Integer factor to shrink the images by while decoding
 @return     images: List of black-and-white images
 @return     distances: List of focus distances corresponding to each image
 '''
-def loadImages(folder=DEFAULT_IMG_DIR):
+def loadImages(folder=DEFAULT_IMG_DIR, downscale=1):
+    if os.path.isfile(folder):
+        return loadStack(folder, downscale=downscale)
     images = []
     distances = []
-    for file in os.listdir(folder):
-        img = img_util.readImageBW(os.path.join(folder, file))
+    for distance, path in folder_index.getFrames(folder):
+        img = img_util.readImageBW(path, downscale=downscale)
         if img is not None:
             images.append(img)
-            distances.append(int(file[9:13]))
-            print file
+            distances.append(distance)
+            instrumentation.report(os.path.basename(path), logging.DEBUG)
     return images, distances
 
 
+'''
+@name       loadStack
+@brief      Maps a frame_stack file into memory, returning each frame as a zero-copy
+            view so that no image is decoded or read until it is used
+@param[in]  path: String representing path of the stack file
+@param[in]  downscale: Integer factor to shrink the images by (this makes copies)
+@return     images: List of black-and-white images
+@return     distances: List of focus distances corresponding to each image
+'''
+def loadStack(path, downscale=1):
+    distances, frames = frame_stack.openStack(path)
+    images = [img_util.downscaleImage(frame, downscale) for frame in frames]
+    return images, distances.tolist()
+
+
 '''
 @name       getSharpness
 @brief      Calculates the derivative in the x direction of images in a list and
@@ -44,30 +85,443 @@ def getSharpness(images):
     sharpness_vals = []
     derivative_imgs = []
     for img in images:
-        derivative = cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=5)
+        derivative, sharpness = calcSharpness(img)
         derivative_imgs.append(derivative)
-        sharpness_vals.append(cv2.norm(derivative))
+        sharpness_vals.append(sharpness)
     return derivative_imgs, sharpness_vals
 
 
+'''
+@name       calcSharpness
+@brief      Calculates the derivative in the x direction of a single image and
+            finds the sharpness given by the L2-Norm of the matrix
+@param[in]  img: A grayscale image
+@return     derivative: The image derivative
+@return     sharpness: The calculated sharpness value
+'''
+@instrumentation.timed('sobel_norm')
+def calcSharpness(img):
+    derivative = cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=SOBEL_KSIZE)
+    return derivative, cv2.norm(derivative)
+
+
+'''
+@name       getDerivativeBuffer
+@brief      Provides a buffer for the derivative of an image, reusing the previous
+            buffer when it already has the right shape
+@param[in]  shape: Shape of the image
+@param[in]  depth: 'int16' or 'float32'
+@param[in]  buf: The previous buffer, or None
+@return     np.array: Buffer of the given shape and depth
+'''
+def getDerivativeBuffer(shape, depth=DEFAULT_LOW_MEMORY_DEPTH, buf=None):
+    dtype = LOW_MEMORY_DTYPES[depth]
+    if buf is not None and buf.shape == shape and buf.dtype == dtype:
+        return buf
+    return np.empty(shape, dtype=dtype)
+
+
+'''
+@name       calcSharpnessInto
+@brief      Calculates the sharpness of a single image as calcSharpness, writing the
+            derivative into a preallocated int16 or float32 buffer instead of a new
+            64-bit float image
+@param[in]  img: A uint8 grayscale image
+@param[in]  dst: Buffer from getDerivativeBuffer with the shape of img
+@return     sharpness: The calculated sharpness value
+'''
+@instrumentation.timed('sobel_norm')
+def calcSharpnessInto(img, dst):
+    depth = getattr(cv2, LOW_MEMORY_DEPTHS['int16' if dst.dtype == np.int16 else 'float32'])
+    cv2.Sobel(img, depth, 1, 0, dst=dst, ksize=SOBEL_KSIZE)
+    return cv2.norm(dst)
+
+
+'''
+@name       getSharpnessLowMemory
+@brief      Calculates the sharpness of images in a list as getSharpness, reusing one
+            derivative buffer and keeping no derivative images
+@param[in]  images: A list (or any iterable) of uint8 grayscale images
+@param[in]  depth: 'int16' or 'float32'
+@return     sharpness_vals: A list of floats containing all calculated sharpness values
+'''
+def getSharpnessLowMemory(images, depth=DEFAULT_LOW_MEMORY_DEPTH):
+    buf = None
+    sharpness_vals = []
+    for img in images:
+        buf = getDerivativeBuffer(img.shape, depth, buf)
+        sharpness_vals.append(calcSharpnessInto(img, buf))
+    return sharpness_vals
+
+
+'''
+@name       getMaxRSS
+@brief      Finds the peak resident memory of this process
+@return     int: Bytes, or None where the resource module is unavailable
+'''
+def getMaxRSS():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+'''
+@name       getPointsLowMemory
+@brief      Finds (focus distance, sharpness) data points for a folder of images
+            decoding and measuring one image at a time into a single reused
+            derivative buffer, for targets with little memory
+@param[in]  folder: String representing path to folder containing images
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  depth: 'int16' or 'float32'
+@return     points: List of 2-tuples representing (x,y) coordinates
+@return     memory: dict with the peak bytes held in image and derivative buffers
+                    ('buffer_bytes') and the peak resident memory of the process
+                    ('max_rss_bytes', None if unavailable)
+'''
+def getPointsLowMemory(folder=DEFAULT_IMG_DIR, downscale=1, depth=DEFAULT_LOW_MEMORY_DEPTH):
+    buf = None
+    buffer_bytes = 0
+    points = []
+    for distance, path in folder_index.getFrames(folder):
+        img = img_util.readImageBW(path, downscale=downscale)
+        if img is None:
+            continue
+        buf = getDerivativeBuffer(img.shape, depth, buf)
+        points.append((distance, calcSharpnessInto(img, buf)))
+        buffer_bytes = max(buffer_bytes, img.nbytes + buf.nbytes)
+        img = None
+    memory = {'buffer_bytes': buffer_bytes, 'max_rss_bytes': getMaxRSS()}
+    instrumentation.logger.debug('Peak buffer memory: %d bytes', buffer_bytes)
+    return sorted(points), memory
+
+
+'''
+@name       getRegions
+@brief      Converts a region of interest into a list of weighted rectangles
+@param[in]  roi: A rectangle (x, y, width, height) in full-resolution pixels, or a list
+                 of rectangles and/or (rectangle, weight) pairs
+@return     regions: List of ((x, y, width, height), weight)
+'''
+def getRegions(roi):
+    if isinstance(roi[0], numbers.Number):
+        return [(tuple(roi), 1.0)]
+    regions = []
+    for region in roi:
+        if isinstance(region[0], numbers.Number):
+            regions.append((tuple(region), 1.0))
+        else:
+            regions.append((tuple(region[0]), float(region[1])))
+    return regions
+
+
+'''
+@name       calcRegionSharpness
+@brief      Calculates the sharpness of an image only within a region of interest,
+            convolving just the pixels of each rectangle and the border the Sobel
+            kernel needs around it
+@param[in]  img: A grayscale image, possibly decoded at a reduced size
+@param[in]  roi: A rectangle (x, y, width, height) in full-resolution pixels, or a list
+                 of rectangles and/or (rectangle, weight) pairs
+@param[in]  downscale: The factor img was shrunk by, used to scale the rectangles
+@param[in]  measure: Name of the focus measure in focus_measures
+@return     sharpness: The weighted sum of the sharpness of each rectangle
+'''
+@instrumentation.timed('sobel_norm')
+def calcRegionSharpness(img, roi, downscale=1, measure=DEFAULT_MEASURE):
+    height, width = img.shape[:2]
+    sharpness = 0.0
+    for (x, y, w, h), weight in getRegions(roi):
+        # Scale the rectangle to the size of the image, rounding outwards
+        x0 = max(0, int(x) // downscale)
+        y0 = max(0, int(y) // downscale)
+        x1 = min(width, -(-int(x + w) // downscale))
+        y1 = min(height, -(-int(y + h) // downscale))
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError('Region %s is outside of the image' % str((x, y, w, h)))
+        if measure != DEFAULT_MEASURE:
+            sharpness += weight * focus_measures.calcFocusMeasure(img[y0:y1,x0:x1], measure)
+            continue
+
+        # Convolve the rectangle with its border so pixels at its edges
+        # have the same derivative as in the full image
+        bx0 = max(0, x0 - SOBEL_BORDER)
+        by0 = max(0, y0 - SOBEL_BORDER)
+        bx1 = min(width, x1 + SOBEL_BORDER)
+        by1 = min(height, y1 + SOBEL_BORDER)
+        derivative = cv2.Sobel(img[by0:by1,bx0:bx1], cv2.CV_64F, 1, 0, ksize=SOBEL_KSIZE)
+        sharpness += weight * cv2.norm(derivative[y0-by0:y1-by0,x0-bx0:x1-bx0])
+    return sharpness
+
+
+'''
+@name       getRegionSharpness
+@brief      Calculates the sharpness of each image in a list within a region of interest
+@param[in]  images: A list of grayscale images
+@param[in]  roi: A rectangle (x, y, width, height) in full-resolution pixels, or a list
+                 of rectangles and/or (rectangle, weight) pairs
+@param[in]  downscale: The factor the images were shrunk by
+@param[in]  measure: Name of the focus measure in focus_measures
+@return     sharpness_vals: A list of floats containing all calculated sharpness values
+'''
+def getRegionSharpness(images, roi, downscale=1, measure=DEFAULT_MEASURE):
+    return [calcRegionSharpness(img, roi, downscale, measure) for img in images]
+
+
+'''
+@name       getMeasureSharpness
+@brief      Calculates the sharpness of each image in a list with a focus measure
+            selected by name, without keeping any derivative images
+@param[in]  images: A list of grayscale images
+@param[in]  measure: Name of the focus measure in focus_measures
+@return     sharpness_vals: A list of floats containing all calculated sharpness values
+'''
+def getMeasureSharpness(images, measure=DEFAULT_MEASURE):
+    return [focus_measures.calcFocusMeasure(img, measure) for img in images]
+
+
+'''
+@name       measureImageFile
+@brief      Decodes a single image file and calculates its sharpness, keeping no
+            image data once it returns. Defined at module level so that it can
+            be sent to a process pool
+@param[in]  job: 6-tuple (path, distance, derivative_path, roi, downscale, measure),
+                 where derivative_path is where the image derivative is written, or
+                 None to discard it, and roi, downscale and measure are as in
+                 calcRegionSharpness, or 7-tuple which also has whether to return
+                 the derivative (default measure without an roi only)
+@return     (distance, sharpness), or (distance, sharpness, derivative) if the
+            derivative is kept, or None if the file is not an image
+'''
+def measureImageFile(job):
+    path, distance, derivative_path, roi, downscale, measure = job[:6]
+    keep_derivative = len(job) > 6 and job[6]
+    img = img_util.readImageBW(path, downscale=downscale)
+    if img is None:
+        return None
+    if roi is not None:
+        return distance, calcRegionSharpness(img, roi, downscale, measure)
+    if measure != DEFAULT_MEASURE:
+        return distance, focus_measures.calcFocusMeasure(img, measure)
+    derivative, sharpness = calcSharpness(img)
+    if derivative_path is not None:
+        img_util.saveImageBW(derivative_path, derivative)
+    if keep_derivative:
+        return distance, sharpness, derivative
+    return distance, sharpness
+
+
+'''
+@name       measureImageFileWithPath
+@brief      measureImageFile which also returns the path of the image, so that
+            results arriving out of order can be matched to their file
+@param[in]  job: 6- or 7-tuple as in measureImageFile
+@return     (path, result of measureImageFile)
+'''
+def measureImageFileWithPath(job):
+    return job[0], measureImageFile(job)
+
+
+'''
+@name       streamPoints
+@brief      Decodes and calculates the sharpness of every image in a folder on a pool
+            of workers, yielding each result as soon as its image is finished.
+            Only the images currently being processed are held in memory
+@param[in]  folder: String representing path to folder containing images
+@param[in]  workers: Number of images processed concurrently
+@param[in]  use_processes: Whether to use a process pool instead of a thread pool
+                           (OpenCV releases the GIL, so threads are usually enough)
+@param[in]  derivative_dir: Folder to write image derivatives to, or None to discard them
+                            (only written for the default measure without an roi)
+@param[in]  roi: Region of interest as in calcRegionSharpness, or None for the full image
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  measure: Name of the focus measure in focus_measures
+@param[in]  cache: sharpness_cache.SharpnessCache to look up and store results in,
+                   or None to always decode and measure every image
+@param[in]  frames: List of (focus distance, path) to measure instead of every
+                    frame in folder, as returned by folder_index.getFrames
+@param[in]  keep_derivatives: Whether to also yield each image derivative in memory
+                              (only for the default measure without an roi). Every
+                              image is then measured, without the cache
+@return     generator of (focus distance, sharpness) in order of completion, or
+            (focus distance, sharpness, derivative) if keep_derivatives
+'''
+def streamPoints(folder=DEFAULT_IMG_DIR, workers=DEFAULT_WORKERS, use_processes=False,
+                 derivative_dir=None, roi=None, downscale=1, measure=DEFAULT_MEASURE,
+                 cache=None, frames=None, keep_derivatives=False):
+    focus_measures.getMeasure(measure)
+    if keep_derivatives and (roi is not None or measure != DEFAULT_MEASURE):
+        raise ValueError('Derivatives are only kept for the default measure without an roi')
+    params = {'roi': roi, 'downscale': downscale}
+    if frames is None:
+        frames = folder_index.getFrames(folder)
+    jobs = []
+    for i, (distance, path) in enumerate(frames):
+        derivative_path = None
+        if derivative_dir is not None:
+            derivative_path = os.path.join(derivative_dir, 'img_' + str(i) + '.png')
+        job = (path, distance, derivative_path, roi, downscale, measure, keep_derivatives)
+
+        # Images whose derivative is not needed can be served from the cache
+        if cache is not None and derivative_path is None and not keep_derivatives:
+            sharpness = cache.get(job[0], measure, params)
+            if sharpness is not None:
+                yield distance, sharpness
+                continue
+        jobs.append(job)
+    if not jobs:
+        return
+
+    if use_processes:
+        # Timers recorded in the workers are sent back with each result
+        pool = multiprocessing.Pool(workers, instrumentation.initWorker,
+                                    instrumentation.getWorkerState())
+        results = instrumentation.mergeResults(pool.imap_unordered(
+            instrumentation.WorkerJob(measureImageFileWithPath), jobs))
+    else:
+        pool = ThreadPool(workers)
+        results = pool.imap_unordered(measureImageFileWithPath, jobs)
+    try:
+        for path, result in results:
+            if result is None:
+                continue
+            if cache is not None:
+                cache.put(path, measure, params, result[1])
+            yield result
+        pool.close()
+    finally:
+        # Also stops outstanding work if the consumer stops iterating early
+        pool.terminate()
+        pool.join()
+
+
 '''
 @name       getPoints
 @brief      Finds (focus distance, sharpness) data points for a set of images
 @param[in]  subject_name: The subject name to search for
 @param[in]  show_images: Whether to display image derivatives using matplotlib 
+@param[in]  roi: Region of interest as in calcRegionSharpness, or None for the full image
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  measure: Name of the focus measure in focus_measures. Image derivatives are
+                     only saved for the default measure without an roi
+@param[in]  cache: sharpness_cache.SharpnessCache to look up and store results in, or
+                   None. Images found in the cache are not decoded, so no derivatives
+                   are saved or shown when a cache is used
 @return     points: List of 2-tuples representing (x,y) coordinates 
 '''
-def getPoints(subject_name='111', show_images=False):
-    images, distances = loadImages(folder=DEFAULT_IMG_DIR+subject_name)
+def getPoints(subject_name='111', show_images=False, roi=None, downscale=1,
+              measure=DEFAULT_MEASURE, cache=None):
+    focus_measures.getMeasure(measure)
+    if cache is not None:
+        return sorted(streamPoints(DEFAULT_IMG_DIR+subject_name, roi=roi, downscale=downscale,
+                                   measure=measure, cache=cache))
+    images, distances = loadImages(folder=DEFAULT_IMG_DIR+subject_name, downscale=downscale)
+    if roi is not None:
+        sharpness_vals = getRegionSharpness(images, roi, downscale, measure)
+        return sorted(zip(distances, sharpness_vals))
+    if measure != DEFAULT_MEASURE:
+        sharpness_vals = getMeasureSharpness(images, measure)
+        return sorted(zip(distances, sharpness_vals))
     derivative_imgs, sharpness_vals = getSharpness(images)
     for i, img in enumerate(derivative_imgs):
         if show_images:
             img_util.plot(img, 'IMAGE', cmap='gray')
         img_util.saveImageBW('img_' + str(i) + '.png', img)    
-        print 'Sharpness for img %d: %f' % (i, sharpness_vals[i])
+        instrumentation.report('Sharpness for img %d: %f' % (i, sharpness_vals[i]), logging.DEBUG)
     return sorted(zip(distances, sharpness_vals))
 
 
+'''
+@name       getPointsParallel
+@brief      Finds (focus distance, sharpness) data points for a set of images
+            using streamPoints, without keeping any images in memory
+@param[in]  subject_name: The subject name to search for
+@param[in]  workers: Number of images processed concurrently
+@param[in]  use_processes: Whether to use a process pool instead of a thread pool
+@param[in]  derivative_dir: Folder to write image derivatives to, or None to discard them
+@param[in]  roi: Region of interest as in calcRegionSharpness, or None for the full image
+@param[in]  downscale: Integer factor to shrink the images by while decoding
+@param[in]  measure: Name of the focus measure in focus_measures
+@param[in]  cache: sharpness_cache.SharpnessCache to look up and store results in, or None
+@param[in]  keep_derivatives: Whether to also return the image derivatives in memory
+@return     points: List of 2-tuples representing (x,y) coordinates
+@return     derivatives: List of the image derivative of each point, only if keep_derivatives
+'''
+def getPointsParallel(subject_name='111', workers=DEFAULT_WORKERS, use_processes=False,
+                      derivative_dir=None, roi=None, downscale=1, measure=DEFAULT_MEASURE,
+                      cache=None, keep_derivatives=False):
+    results = sorted(streamPoints(DEFAULT_IMG_DIR+subject_name, workers=workers,
+                                  use_processes=use_processes, derivative_dir=derivative_dir,
+                                  roi=roi, downscale=downscale, measure=measure, cache=cache,
+                                  keep_derivatives=keep_derivatives),
+                     key=lambda result: result[0])
+    if keep_derivatives:
+        return [r[:2] for r in results], [r[2] for r in results]
+    return results
+
+
+'''
+@name       getPointsCoarseToFine
+@brief      Finds (focus distance, sharpness) data points around the sharpest frame
+            without measuring every frame at full resolution. Every frame is first
+            scored on a heavily downscaled pyramid level, then only the frames within
+            margin of the coarse peak are rescored at full resolution. If the full
+            resolution peak lands on the edge of that bracket, the bracket is widened
+            until the peak is inside it (or at the end of the sweep)
+@param[in]  folder: String representing path to folder containing images
+@param[in]  coarse_downscale: Integer factor to shrink the images by for the coarse pass
+@param[in]  margin: Number of frames on each side of the coarse peak to rescore
+@param[in]  workers: Number of images processed concurrently
+@param[in]  use_processes: Whether to use a process pool instead of a thread pool
+@param[in]  measure: Name of the focus measure in focus_measures
+@param[in]  cache: sharpness_cache.SharpnessCache to look up and store results in, or None
+@return     points: List of 2-tuples representing (x,y) coordinates of the
+                    frames rescored at full resolution
+'''
+def getPointsCoarseToFine(folder=DEFAULT_IMG_DIR, coarse_downscale=COARSE_DOWNSCALE,
+                          margin=BRACKET_MARGIN, workers=DEFAULT_WORKERS, use_processes=False,
+                          measure=DEFAULT_MEASURE, cache=None):
+    frames = folder_index.getFrames(folder)
+    index = dict((f[0], i) for i, f in enumerate(frames))
+
+    coarse = {}
+    with instrumentation.timer('coarse_pass'):
+        for distance, sharpness in streamPoints(workers=workers, use_processes=use_processes,
+                                                downscale=coarse_downscale, measure=measure,
+                                                cache=cache, frames=frames):
+            coarse[index[distance]] = sharpness
+    if not coarse:
+        return []
+    peak = max(coarse, key=coarse.get)
+    low = max(peak - margin, 0)
+    high = min(peak + margin, len(frames) - 1)
+
+    fine = {}
+    measured = set()
+    while True:
+        bracket = [frames[i] for i in range(low, high + 1) if i not in measured]
+        measured.update(range(low, high + 1))
+        with instrumentation.timer('fine_pass'):
+            for distance, sharpness in streamPoints(workers=workers, use_processes=use_processes,
+                                                    measure=measure, cache=cache, frames=bracket):
+                fine[index[distance]] = sharpness
+        instrumentation.count('fine_frames', len(bracket))
+        if not fine:
+            return []
+        best = max(fine, key=fine.get)
+        if best == low and low > 0:
+            low = max(low - margin, 0)
+        elif best == high and high < len(frames) - 1:
+            high = min(high + margin, len(frames) - 1)
+        else:
+            break
+    instrumentation.count('coarse_frames', len(frames))
+    return sorted((frames[i][0], fine[i]) for i in fine)
+
+
 #######################
 ###  Main Function  ###
 #######################
@@ -0,0 +1,189 @@
+'''
+@name    spline_fitter.py
+@brief   Fits natural cubic splines for a fixed schedule of focus distances.
+         The tridiagonal system in the second derivatives only depends on the
+         focus distances, so it is factorized once and every new set of
+         sharpness values only requires forward and back substitution.
+         For many noisy frames, SmoothingSplineFitter instead fits a natural cubic
+         spline with a small number of fixed knots by penalized least squares
+@author  Russell Wong, 2017
+'''
+
+import sys
+from collections import OrderedDict
+import numpy as np
+
+import cubic_spline, thomas_algorithm, gaussian_elimination
+
+MAX_CACHED_FITTERS = 8
+DEFAULT_NUM_KNOTS = 8
+
+# Fitters shared by getFitter, keyed by focus distance schedule
+# and ordered from least to most recently used
+_fitter_cache = OrderedDict()
+
+
+'''
+@name       CubicSplineFitter
+@brief      Natural cubic spline fitter for a fixed set of focus distances
+@param[in]  x_vals: focus distances of the data points (ordered)
+'''
+class CubicSplineFitter(object):
+    def __init__(self, x_vals):
+        self.x_vals = np.array(x_vals, dtype=np.float64)
+        if len(self.x_vals) <= 1:
+            raise ValueError('Not enough points to fit a spline')
+        if np.any(np.diff(self.x_vals) <= 0):
+            raise ValueError('Focus distances must be strictly increasing')
+
+        # The rhs is computed per fit, only the diagonals are kept
+        lower, diag, upper, _ = cubic_spline.getTridiagonalSystem(
+            self.x_vals, np.zeros(len(self.x_vals)))
+        self.factor = thomas_algorithm.factorize(lower, diag, upper)
+
+    '''
+    @name       fit
+    @brief      solve for the spline coefficients through the sharpness values
+    @param[in]  y_vals: sharpness values at each focus distance, either of shape (N,)
+                        or (N,k) for k sharpness profiles at once
+    @return     coefficients: vector of a,b,c,d coefficients for each cubic function,
+                              in the layout returned by cubic_spline.getCoefficients
+    '''
+    def fit(self, y_vals):
+        y_vals = np.asarray(y_vals, dtype=np.float64)
+        if y_vals.shape[0] != len(self.x_vals):
+            raise ValueError('Expected %d sharpness values, got %d'
+                             % (len(self.x_vals), y_vals.shape[0]))
+        _, _, _, rhs = cubic_spline.getTridiagonalSystem(self.x_vals, y_vals)
+        M = thomas_algorithm.substitute(self.factor, rhs)
+        return cubic_spline.getCoefficientsFromSecondDerivatives(self.x_vals, y_vals, M)
+
+
+'''
+@name       SmoothingSplineFitter
+@brief      Penalized least-squares natural cubic spline with a fixed number of
+            evenly spaced knots, for a fixed set of focus distances. The spline is
+            linear in its values z at the knots, S(x) = B(x) z, so the fit solves the
+            normal equations (B^T B + smoothing*P) z = B^T y, where P is the integral
+            of the squared second derivative. The KxK normal matrix is factorized once,
+            so every fit costs O(N*K) for B^T y plus O(K^2) substitution, and the
+            curve is no longer forced through every noisy sample
+@param[in]  x_vals: focus distances of the data points (ordered)
+            num_knots: number of knots, including both endpoints (at most len(x_vals))
+            smoothing: weight of the curvature penalty, 0 for plain least squares
+'''
+class SmoothingSplineFitter(object):
+    def __init__(self, x_vals, num_knots=DEFAULT_NUM_KNOTS, smoothing=0.0):
+        self.x_vals = np.array(x_vals, dtype=np.float64)
+        if len(self.x_vals) <= 1:
+            raise ValueError('Not enough points to fit a spline')
+        if np.any(np.diff(self.x_vals) <= 0):
+            raise ValueError('Focus distances must be strictly increasing')
+        if num_knots < 2:
+            raise ValueError('At least 2 knots are required')
+        if smoothing < 0:
+            raise ValueError('smoothing must be non-negative')
+        num_knots = min(num_knots, len(self.x_vals))
+        self.knots = np.linspace(self.x_vals[0], self.x_vals[-1], num_knots)
+        self.smoothing = smoothing
+        self.knot_fitter = CubicSplineFitter(self.knots)
+
+        # Coefficients of the interpolating spline through each unit knot vector,
+        # one column per knot, as (interval, a/b/c/d, knot)
+        identity = np.eye(num_knots)
+        basis_coefficients = self.knot_fitter.fit(identity).reshape((num_knots - 1, 4, num_knots))
+
+        # Evaluate the basis at every focus distance, with the same interval
+        # convention as spline_function.CubicSpline
+        index = np.clip(np.searchsorted(self.knots, self.x_vals, side='left') - 1, 0, num_knots - 2)
+        c = basis_coefficients[index]
+        x = self.x_vals[:, np.newaxis]
+        self.basis = ((c[:,0]*x + c[:,1])*x + c[:,2])*x + c[:,3]
+
+        normal = np.dot(self.basis.T, self.basis)
+        if smoothing > 0:
+            normal += smoothing*self.getPenalty(identity)
+        self.LU, self.perm = gaussian_elimination.factorize(normal, overwrite=True)
+
+    '''
+    @name       getPenalty
+    @brief      build P with z^T P z equal to the integral of S''(x)^2 over the knots.
+                S'' is linear between knots, so each interval contributes
+                h/3*(M_i^2 + M_i*M_i+1 + M_i+1^2) in the second derivatives M
+    @param[in]  identity: KxK identity matrix
+    @return     np.array: KxK penalty matrix
+    '''
+    def getPenalty(self, identity):
+        _, _, _, rhs = cubic_spline.getTridiagonalSystem(self.knots, identity)
+        M = thomas_algorithm.substitute(self.knot_fitter.factor, rhs)
+        h = np.diff(self.knots)
+        R = np.zeros((len(h) + 1, len(h) + 1))
+        i = np.arange(len(h))
+        R[i, i] += h/3
+        R[i+1, i+1] += h/3
+        R[i, i+1] += h/6
+        R[i+1, i] += h/6
+        return np.dot(M.T, np.dot(R, M))
+
+    '''
+    @name       fit
+    @brief      solve for the spline coefficients which best fit the sharpness values
+    @param[in]  y_vals: sharpness values at each focus distance, either of shape (N,)
+                        or (N,k) for k sharpness profiles at once
+    @return     coefficients: vector of a,b,c,d coefficients for each cubic function
+                              between the knots, in the layout returned by
+                              cubic_spline.getCoefficients; evaluate it over self.knots
+    '''
+    def fit(self, y_vals):
+        y_vals = np.asarray(y_vals, dtype=np.float64)
+        if y_vals.shape[0] != len(self.x_vals):
+            raise ValueError('Expected %d sharpness values, got %d'
+                             % (len(self.x_vals), y_vals.shape[0]))
+        z = gaussian_elimination.substitute(self.LU, self.perm, np.dot(self.basis.T, y_vals))
+        return self.knot_fitter.fit(z)
+
+
+'''
+@name       getFitter
+@brief      retrieve a fitter for a focus distance schedule, reusing the
+            factorization if the same schedule was fitted recently
+@param[in]  x_vals: focus distances of the data points (ordered)
+            cache_size: number of schedules to keep before evicting
+                        the least recently used one
+            num_knots: number of knots for a SmoothingSplineFitter, or None
+                       to interpolate every point with a CubicSplineFitter
+            smoothing: weight of the curvature penalty for a SmoothingSplineFitter
+@return     CubicSplineFitter or SmoothingSplineFitter: fitter for the schedule
+'''
+def getFitter(x_vals, cache_size=MAX_CACHED_FITTERS, num_knots=None, smoothing=0.0):
+    key = (tuple(float(x) for x in x_vals), num_knots, smoothing)
+    fitter = _fitter_cache.pop(key, None)
+    if fitter is None:
+        if num_knots is None:
+            fitter = CubicSplineFitter(key[0])
+        else:
+            fitter = SmoothingSplineFitter(key[0], num_knots, smoothing)
+    _fitter_cache[key] = fitter
+    while len(_fitter_cache) > cache_size:
+        _fitter_cache.popitem(last=False)
+    return fitter
+
+
+'''
+@name       clearCache
+@brief      remove all cached fitters
+'''
+def clearCache():
+    _fitter_cache.clear()
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    sample_points = [(0,0),(1,3),(2,1),(4,5)]
+    x_vals = [p[0] for p in sample_points]
+    y_vals = [p[1] for p in sample_points]
+    fitter = getFitter(x_vals)
+    print(fitter.fit(y_vals))
+    sys.exit()
@@ -0,0 +1,72 @@
+'''
+@name    spline_function.py
+@brief   Evaluates a cubic spline given the a,b,c,d coefficients of
+         each cubic function, vectorized over any number of x values
+@author  Russell Wong, Yun-Ha Jung 2017
+'''
+
+import sys
+import numpy as np
+
+import instrumentation
+
+'''
+@name       CubicSpline
+@brief      Callable cubic spline function
+@param[in]  coefficients: A vector of a,b,c,d coefficients representing each cubic
+                          function in the spline, as solved from cubic_spline
+            x_vals: A vector of distance values corresponding to the endpoints of each
+                    cubic function in the spline
+'''
+class CubicSpline(object):
+    def __init__(self, coefficients, x_vals):
+        self.x_vals = np.array(x_vals, dtype=np.float64).ravel()
+        n = len(self.x_vals) - 1
+        if n < 1:
+            raise ValueError('Not enough points to define a spline')
+        # One row of a,b,c,d per cubic function
+        self.coefficients = np.asarray(coefficients, dtype=np.float64).reshape((n, 4))
+        self.x_min = self.x_vals[0]
+        self.x_max = self.x_vals[-1]
+
+    '''
+    @name       intervals
+    @brief      find the index of the cubic function each x value belongs to
+    @param[in]  x: distance values, a scalar or a NumPy array
+    @return     np.array: interval indices with the same shape as x
+    '''
+    def intervals(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if np.any(x < self.x_min) or np.any(x > self.x_max) or np.any(np.isnan(x)):
+            raise ValueError('x is out of the bounds of x_vals (%f,%f)'
+                             % (self.x_min, self.x_max))
+        # x equal to an endpoint belongs to the interval on its left,
+        # except for the first endpoint
+        index = np.searchsorted(self.x_vals, x, side='left') - 1
+        return np.clip(index, 0, len(self.coefficients) - 1)
+
+    '''
+    @name       __call__
+    @brief      evaluate the spline using Horner's method
+    @param[in]  x: distance values, a scalar or a NumPy array
+    @return     sharpness values with the same shape as x (a float for scalar x)
+    '''
+    def __call__(self, x):
+        x_arr = np.asarray(x, dtype=np.float64)
+        instrumentation.count('spline_evaluations', x_arr.size)
+        c = self.coefficients[self.intervals(x_arr)]
+        y = ((c[...,0]*x_arr + c[...,1])*x_arr + c[...,2])*x_arr + c[...,3]
+        if y.ndim == 0:
+            return float(y)
+        return y
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    # y = x^3 on [0,1] and y = 3x^2 - 3x + 1 on [1,2]
+    spline = CubicSpline([1,0,0,0,0,3,-3,1], [0,1,2])
+    print(spline(0.5))
+    print(spline(np.linspace(0, 2, 5)))
+    sys.exit()
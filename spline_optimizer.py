@@ -0,0 +1,158 @@
+'''
+@name    spline_optimizer.py
+@brief   Finds the maximum of a cubic spline analytically. The derivative of each
+         cubic function is a quadratic, so its critical points are found exactly
+         from the quadratic formula, vectorized over all cubic functions at once
+@author  Yun-Ha Jung, Russell Wong, 2017
+'''
+
+import sys
+import numpy as np
+
+'''
+@name       getLocalCoefficients
+@brief      re-express each cubic function relative to its left endpoint,
+            A*t^3 + B*t^2 + C*t + D where t = x - x_vals[i], which keeps the
+            root finding well conditioned for large focus distances
+@param[in]  coefficients: A vector of a,b,c,d coefficients representing each cubic function in the spline
+            x_vals: A vector of distance values corresponding to the endpoints of each cubic function in the spline
+@return     np.array: (N-1) x 4 array of A,B,C,D for each cubic function
+'''
+def getLocalCoefficients(coefficients, x_vals):
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    n = len(x_vals) - 1
+    c = np.asarray(coefficients, dtype=np.float64).reshape((n, 4))
+    x0 = x_vals[:-1]
+
+    local = np.empty((n, 4))
+    local[:,0] = c[:,0]
+    local[:,1] = c[:,1] + 3*c[:,0]*x0
+    local[:,2] = c[:,2] + (2*c[:,1] + 3*c[:,0]*x0)*x0
+    local[:,3] = ((c[:,0]*x0 + c[:,1])*x0 + c[:,2])*x0 + c[:,3]
+    return local
+
+
+'''
+@name       findPeaks
+@brief      find the local maxima of a cubic spline, ranked by sharpness
+@param[in]  coefficients: A vector of a,b,c,d coefficients representing each cubic function in the spline
+            x_vals: A vector of distance values corresponding to the endpoints of each cubic function in the spline
+            k: maximum number of peaks to return (all peaks if None)
+@return     peaks: list of (x,y) local maxima, from highest to lowest
+'''
+def findPeaks(coefficients, x_vals, k=None):
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    local = getLocalCoefficients(coefficients, x_vals)
+    A, B, C, D = local[:,0], local[:,1], local[:,2], local[:,3]
+    h = np.diff(x_vals)
+
+    # Critical points are the roots of 3A*t^2 + 2B*t + C = 0
+    # Use the numerically stable form of the quadratic formula, where a root
+    # of q/0 (linear derivative) becomes infinite and is discarded below
+    qa, qb, qc = 3*A, 2*B, C
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc = qb**2 - 4*qa*qc
+        sqrt_disc = np.sqrt(np.where(disc >= 0, disc, np.nan))
+        q = -0.5*(qb + np.where(qb >= 0, 1.0, -1.0)*sqrt_disc)
+        roots = np.stack([q/qa, qc/q], axis=1)
+        # A local maximum has a negative second derivative 6A*t + 2B
+        curvature = 6*A[:,None]*roots + 2*B[:,None]
+    valid = np.isfinite(roots) & (roots >= 0) & (roots <= h[:,None]) & (curvature < 0)
+
+    segment = np.nonzero(valid)[0]
+    t = roots[valid]
+    peak_x = x_vals[segment] + t
+    peak_y = ((A[segment]*t + B[segment])*t + C[segment])*t + D[segment]
+
+    # The endpoints of the spline are peaks if the function falls away from them,
+    # or is flat there (a plateau at an endpoint is still the highest point nearby)
+    end_h = h[-1]
+    end_slope = (3*A[-1]*end_h + 2*B[-1])*end_h + C[-1]
+    end_y = ((A[-1]*end_h + B[-1])*end_h + C[-1])*end_h + D[-1]
+    if C[0] <= 0:
+        peak_x = np.append(peak_x, x_vals[0])
+        peak_y = np.append(peak_y, D[0])
+    if end_slope >= 0:
+        peak_x = np.append(peak_x, x_vals[-1])
+        peak_y = np.append(peak_y, end_y)
+
+    # A peak exactly on an internal point is found from both neighbouring cubics
+    order = np.argsort(-peak_y, kind='mergesort')
+    peaks = []
+    for i in order:
+        if peaks and any(abs(peak_x[i] - p[0]) <= 1e-9*max(1.0, abs(p[0])) for p in peaks):
+            continue
+        peaks.append((float(peak_x[i]), float(peak_y[i])))
+        if k is not None and len(peaks) >= k:
+            break
+    return peaks
+
+
+'''
+@name       findMaximum
+@brief      find the global maximum of a cubic spline over its full range, the highest
+            of its critical points and both endpoints (as findMaxima for one spline)
+@param[in]  coefficients: A vector of a,b,c,d coefficients representing each cubic function in the spline
+            x_vals: A vector of distance values corresponding to the endpoints of each cubic function in the spline
+@return     optimum: the optimum point (x,y)
+'''
+def findMaximum(coefficients, x_vals):
+    max_x, max_y = findMaxima(np.reshape(coefficients, (-1, 1)), x_vals)
+    return (float(max_x[0]), float(max_y[0]))
+
+
+'''
+@name       findMaxima
+@brief      find the global maximum of many splines over the same focus distances
+            at once, e.g. one spline per image tile. The maximum of each spline is the
+            highest of its critical points and its endpoints, so every candidate is
+            evaluated and the best one picked without looping over the splines
+@param[in]  coefficients: (4*(N-1),k) array of a,b,c,d coefficients, one column per spline,
+                          as returned by spline_fitter for (N,k) sharpness values
+            x_vals: A vector of distance values corresponding to the endpoints of each cubic function in the spline
+@return     max_x: np.array of the optimum focus distance of each spline, shape (k,)
+@return     max_y: np.array of the optimum sharpness of each spline, shape (k,)
+'''
+def findMaxima(coefficients, x_vals):
+    x_vals = np.asarray(x_vals, dtype=np.float64)
+    n = len(x_vals) - 1
+    c = np.asarray(coefficients, dtype=np.float64).reshape((n, 4, -1))
+
+    # Local coefficients as in getLocalCoefficients, for every column
+    x0 = x_vals[:-1,None]
+    A = c[:,0]
+    B = c[:,1] + 3*c[:,0]*x0
+    C = c[:,2] + (2*c[:,1] + 3*c[:,0]*x0)*x0
+    D = ((c[:,0]*x0 + c[:,1])*x0 + c[:,2])*x0 + c[:,3]
+    h = np.diff(x_vals)[:,None]
+
+    qa, qb, qc = 3*A, 2*B, C
+    with np.errstate(divide='ignore', invalid='ignore'):
+        disc = qb**2 - 4*qa*qc
+        sqrt_disc = np.sqrt(np.where(disc >= 0, disc, np.nan))
+        q = -0.5*(qb + np.where(qb >= 0, 1.0, -1.0)*sqrt_disc)
+        # Candidates in each cubic: both critical points and both endpoints
+        t = np.stack([q/qa, qc/q, np.zeros(A.shape), np.broadcast_to(h, A.shape)], axis=1)
+    valid = np.isfinite(t) & (t >= 0) & (t <= h[:,None])
+    t = np.where(valid, t, 0)
+    y = ((A[:,None]*t + B[:,None])*t + C[:,None])*t + D[:,None]
+    y = np.where(valid, y, -np.inf)
+
+    # Pick the best candidate of each column
+    y = y.reshape((4*n, -1))
+    best = np.argmax(y, axis=0)
+    columns = np.arange(y.shape[1])
+    max_x = x_vals[best // 4] + t.reshape((4*n, -1))[best, columns]
+    return max_x, y[best, columns]
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    # y = -x^3 + 5x + 6 on [0,1] and [1,3]
+    coefficients = [-1,0,5,6,-1,0,5,6]
+    x_vals = [0,1,3]
+    print(findMaximum(coefficients, x_vals))
+    print(findPeaks(coefficients, x_vals, k=3))
+    sys.exit()
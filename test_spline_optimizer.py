@@ -0,0 +1,45 @@
+'''
+@name    test_spline_optimizer.py
+@brief   Regression tests for the analytic spline maxima in spline_optimizer
+@author  Yun-Ha Jung, Russell Wong, 2017
+'''
+
+import unittest
+import numpy as np
+
+import spline_optimizer
+
+class FindMaximumTest(unittest.TestCase):
+    def assertPoint(self, point, expected):
+        self.assertAlmostEqual(point[0], expected[0])
+        self.assertAlmostEqual(point[1], expected[1])
+
+    def test_interior_peak(self):
+        # y = -x^3 + 5x + 6, maximum at x = sqrt(5/3)
+        x = np.sqrt(5/3.0)
+        self.assertPoint(spline_optimizer.findMaximum([-1,0,5,6,-1,0,5,6], [0,1,3]),
+                         (x, -x**3 + 5*x + 6))
+
+    def test_flat_right_endpoint(self):
+        # y = x^3 on [-1,0] has zero slope at its maximum x = 0
+        coefficients, x_vals = [1,0,0,0], [-1,0]
+        self.assertPoint(spline_optimizer.findMaximum(coefficients, x_vals), (0, 0))
+        self.assertPoint(spline_optimizer.findPeaks(coefficients, x_vals, k=1)[0], (0, 0))
+
+    def test_flat_left_endpoint(self):
+        # y = (x-1)^3 on [0,1] rises to its flat maximum at x = 1, from y = -1 at x = 0
+        coefficients, x_vals = [1,-3,3,-1], [0,1]
+        self.assertPoint(spline_optimizer.findMaximum(coefficients, x_vals), (1, 0))
+        # y = -x^3 on [0,1] is flat at its maximum x = 0
+        self.assertPoint(spline_optimizer.findMaximum([-1,0,0,0], [0,1]), (0, 0))
+
+    def test_matches_find_maxima(self):
+        coefficients = [[1,0,0,0], [1,-3,3,-1], [-1,0,5,6]]
+        x_vals = [0,1]
+        max_x, max_y = spline_optimizer.findMaxima(np.transpose(coefficients), x_vals)
+        for i, c in enumerate(coefficients):
+            self.assertPoint(spline_optimizer.findMaximum(c, x_vals), (max_x[i], max_y[i]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+@name    thomas_algorithm.py
+@brief   Solves a tridiagonal system of linear equations in the form
+         [A]{x} = {b} using the Thomas Algorithm (banded Gaussian
+         Elimination without pivoting) in O(n) time and memory
+@author  Russell Wong, 2017
+'''
+
+import sys
+import numpy as np
+
+import instrumentation
+
+'''
+@name       factorize
+@brief      perform the elimination stage of the Thomas Algorithm, which only
+            depends on A, so that it can be reused for any right-hand side
+@param[in]  lower: sub-diagonal of A (length n, lower[0] is unused)
+            diag: main diagonal of A (length n)
+            upper: super-diagonal of A (length n, upper[n-1] is unused)
+@return     factor: tuple (lower, denom, c_prime) of the sub-diagonal, the pivots
+                    and the modified super-diagonal after the forward sweep
+'''
+@instrumentation.timed('elimination')
+def factorize(lower, diag, upper):
+    lower = np.asarray(lower, dtype=np.float64)
+    diag = np.asarray(diag, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    n = len(diag)
+
+    # c' is the modified super-diagonal after the forward sweep
+    # eliminates the sub-diagonal
+    c_prime = np.zeros(n)
+    denom = np.zeros(n)
+    for i in range(n):
+        denom[i] = diag[i] - (lower[i]*c_prime[i-1] if i > 0 else 0)
+        if denom[i] == 0:
+            raise ValueError('Zero pivot in tridiagonal system at row %d' % i)
+        c_prime[i] = upper[i] / denom[i]
+
+    return lower, denom, c_prime
+
+
+'''
+@name       substitute
+@brief      solve the tridiagonal system given its factorization
+            using forward and back substitution
+@param[in]  factor: factorization of A returned by factorize
+            rhs: the solution vector b, either of shape (n,) or (n,k) to
+                 solve for k right-hand sides at once
+@return     x: the vector being solved, with the same shape as rhs
+'''
+@instrumentation.timed('back_substitution')
+def substitute(factor, rhs):
+    lower, denom, c_prime = factor
+    d_prime = np.array(rhs, dtype=np.float64)
+    n = len(denom)
+    if n == 0:
+        return d_prime
+
+    ###########################
+    ###  Forward sweep      ###
+    ###########################
+    d_prime[0] /= denom[0]
+    for i in range(1, n):
+        d_prime[i] = (d_prime[i] - lower[i]*d_prime[i-1]) / denom[i]
+
+    ###########################
+    ###  Back substitution  ###
+    ###########################
+    for i in range(n-2, -1, -1):
+        d_prime[i] -= c_prime[i]*d_prime[i+1]
+
+    return d_prime
+
+
+'''
+@name       solve
+@brief      solve tridiagonal system of equations [A]{x} = {b}
+@param[in]  lower: sub-diagonal of A (length n, lower[0] is unused)
+            diag: main diagonal of A (length n)
+            upper: super-diagonal of A (length n, upper[n-1] is unused)
+            rhs: the solution vector b, either of shape (n,) or (n,k) to
+                 solve for k right-hand sides at once
+@return     x: the vector being solved, with the same shape as rhs
+'''
+def solve(lower, diag, upper, rhs):
+    return substitute(factorize(lower, diag, upper), rhs)
+
+
+#######################
+###  Main Function  ###
+#######################
+if __name__ == '__main__':
+    lower = [0, 1, 1, 1]
+    diag = [4, 4, 4, 4]
+    upper = [1, 1, 1, 0]
+    rhs = [5, 6, 6, 5]
+    print(solve(lower, diag, upper, rhs))
+    sys.exit()